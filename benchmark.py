@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import platform
+import itertools
+import subprocess
+import tracemalloc
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+import pyomo
+from pyomo.environ import value
+
+from d3a_input import d3a_opti_input, d3a_opti_input_arrays
+from d3a_opti import d3a_opti, initialize_model, solve_model, d3a_opti_solution
+from d3a_matrix import d3a_opti_matrix, solve_matrix_model, d3a_opti_matrix_solution, arrays_model_data
+from d3a_sweep import d3a_sweep
+from d3a_solvers import available_solvers
+from d3a_monitor import peak_rss_mb
+import nordpool
+
+
+
+# Benchmarks for the optimization pipeline on synthetic communities
+
+
+
+def synthetic_community_data(n_members=10, n_periods=96, freq='15min', battery_share=0.5, start='2021-01-01', seed=0):
+
+    ## Example
+    # from benchmark import synthetic_community_data
+    #
+    # data = synthetic_community_data(n_members=500, n_periods=35040, freq='15min', battery_share=0.1)
+
+    # Input data dictionary in the format of d3a_opti_input() with daily demand,
+    # PV generation and price profiles. The first battery_share of the members have a battery.
+
+    rng = np.random.default_rng(seed)
+
+    timestamps = pd.date_range(start, periods=n_periods, freq=freq)
+    hour = (timestamps.hour + timestamps.minute/60).to_numpy()
+    day = 2*np.pi*hour/24
+
+    market_maker_rate = 0.06 + 0.03*np.sin(day - np.pi/2) + 0.01*rng.random(n_periods)
+    feed_in_tariff = 0.5*market_maker_rate
+    community_fee = np.full(n_periods, 0.01)
+    grid_fee = np.full(n_periods, 0.03)
+    carbon_emission_factor = 120 + 60*rng.random(n_periods)
+
+    sun = np.clip(np.sin(np.pi*(hour - 6)/12), 0, None)
+
+    data = dict()
+    for i in range(n_members):
+
+        has_battery = i < battery_share*n_members
+        capacity = 10.0 if has_battery else 0.0
+
+        data['member_%d' % i] = {
+            'timestamps': timestamps,
+            'market maker rate': market_maker_rate,
+            'feed in tariff': feed_in_tariff,
+            'community fee': community_fee,
+            'grid fee': grid_fee,
+            'carbon emission factor': carbon_emission_factor,
+            'demand': (0.5 + 0.5*rng.random())*(1 + 0.5*np.sin(day + rng.random())) + 0.2*rng.random(n_periods),
+            'generation': 4*rng.random()*sun,
+            'battery': {'min soc': 0.1*capacity,
+                        'capacity': capacity,
+                        'charging power': 0.3*capacity,
+                        'discharging power': 0.3*capacity,
+                        'charging efficiency': 0.95,
+                        'discharging efficiency': 0.95},
+        }
+
+    return data
+
+
+
+def _measure(function, *args):
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = function(*args)
+    t = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, t, peak
+
+
+
+def benchmark_input_memory(n_members=100, n_periods=35040, freq='15min'):
+
+    ## Example
+    # from benchmark import benchmark_input_memory
+    #
+    # r = benchmark_input_memory(n_members=1000, n_periods=35040)
+
+    # Time and peak traced memory of the dictionary (d3a_opti_input) and
+    # array (d3a_opti_input_arrays) input paths on the same synthetic community
+
+    data = synthetic_community_data(n_members, n_periods, freq)
+
+    r = {'members': n_members, 'periods': n_periods}
+
+    model_data, r['dict_time'], r['dict_peak_mb'] = _measure(d3a_opti_input, data)
+    del model_data
+
+    a, r['arrays_time'], r['arrays_peak_mb'] = _measure(d3a_opti_input_arrays, data)
+    del a
+
+    r['dict_peak_mb'] /= 1e6
+    r['arrays_peak_mb'] /= 1e6
+    r['memory_ratio'] = r['dict_peak_mb']/r['arrays_peak_mb']
+
+    print('Input for %d members x %d periods' % (n_members, n_periods))
+    print('  dict:   %8.2f s %10.1f MB' % (r['dict_time'], r['dict_peak_mb']))
+    print('  arrays: %8.2f s %10.1f MB' % (r['arrays_time'], r['arrays_peak_mb']))
+
+    return r
+
+
+
+def _run_backend(data, backend, options):
+
+    # Build, solve and extract times of one backend, 'matrix' is the d3a_matrix engine
+
+    r = {'backend': backend}
+
+    if backend == 'matrix':
+        t0 = time.perf_counter()
+        lp = d3a_opti_matrix(d3a_opti_input_arrays(data))
+        t1 = time.perf_counter()
+        lp = solve_matrix_model(lp, options)
+        t2 = time.perf_counter()
+        d3a_opti_matrix_solution(lp, mode='arrays')
+        t3 = time.perf_counter()
+        r['objective'] = lp['objective']
+    else:
+        t0 = time.perf_counter()
+        model_instance = initialize_model(d3a_opti(), d3a_opti_input(data))
+        t1 = time.perf_counter()
+        model_instance = solve_model(model_instance, solver=backend, options=options)
+        t2 = time.perf_counter()
+        d3a_opti_solution(model_instance, mode='arrays')
+        t3 = time.perf_counter()
+        r['objective'] = value(model_instance.total_cost)
+
+    r['build_time'] = t1 - t0
+    r['solve_time'] = t2 - t1
+    r['extract_time'] = t3 - t2
+
+    return r
+
+
+
+def benchmark_solvers(backends=None, sizes=((10, 96), (50, 96*7)), options=None):
+
+    ## Example
+    # from benchmark import benchmark_solvers
+    #
+    # r = benchmark_solvers(['glpk', 'cbc', 'highs', 'matrix'], sizes=[(100, 96*7)], options={'threads': 1})
+
+    # Build/solve/extract time per backend on the same synthetic communities,
+    # sizes are (members, periods). Backends that are not installed are skipped.
+
+    if backends is None:
+        backends = available_solvers() + ['matrix']
+
+    installed = available_solvers()
+
+    results = []
+    for n_members, n_periods in sizes:
+
+        data = synthetic_community_data(n_members, n_periods)
+
+        for backend in backends:
+            if backend != 'matrix' and backend not in installed:
+                print('Solver %s not available, skipped' % backend)
+                continue
+
+            r = _run_backend(data, backend, options)
+            r['members'] = n_members
+            r['periods'] = n_periods
+            results.append(r)
+
+            print('%4d members x %6d periods %-8s build %8.2f s  solve %8.2f s  extract %8.2f s  objective %.6g' %
+                  (n_members, n_periods, backend, r['build_time'], r['solve_time'], r['extract_time'], r['objective']))
+
+    return results
+
+
+
+def benchmark_sweep(n_members=20, n_periods=96*7, param='community_fee', values=np.linspace(0.0, 0.05, 21), solver='highs', options=None):
+
+    ## Example
+    # from benchmark import benchmark_sweep
+    #
+    # r = benchmark_sweep(50, 96*7, 'carbon_price', np.linspace(0, 500, 51))
+
+    # Time of a parameter sweep with a cold build and solve per point
+    # (initialize_model + solve_model) and with the warm-started d3a_sweep()
+
+    a = d3a_opti_input_arrays(synthetic_community_data(n_members, n_periods))
+    nT = len(a['T'])
+
+    r = {'members': n_members, 'periods': n_periods, 'param': param, 'points': len(values)}
+
+    t0 = time.perf_counter()
+    cold = []
+    for v in values:
+        b = dict(a)
+        b[param] = v if param == 'carbon_price' else np.full(nT, v)
+        model_instance = initialize_model(d3a_opti(), arrays_model_data(b))
+        model_instance = solve_model(model_instance, solver=solver, options=options)
+        cold.append(value(model_instance.total_cost))
+    r['cold_time'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    df = d3a_sweep(a, values, param, solver=solver, options=options)
+    r['warm_time'] = time.perf_counter() - t0
+
+    r['speedup'] = r['cold_time']/r['warm_time']
+    r['max_objective_difference'] = float(np.max(np.abs(df['objective'].to_numpy() - np.array(cold))))
+
+    print('%d members x %d periods, %d values of %s: cold %.2f s, warm %.2f s, speedup %.1fx, objective difference %.2e' %
+          (n_members, n_periods, len(values), param, r['cold_time'], r['warm_time'], r['speedup'], r['max_objective_difference']))
+
+    return r
+
+
+
+def _scaling_run(config, solver, options):
+
+    # One configuration of the scaling suite, run in a fresh process so that
+    # the peak RSS after each stage belongs to this configuration only
+
+    r = dict(config)
+    r['stages'] = {}
+
+    data = synthetic_community_data(config['members'], config['periods'], config['freq'], config['battery_share'])
+    r['baseline_rss_mb'] = peak_rss_mb()
+
+    def stage(name, function, *args):
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        result = function(*args)
+        r['stages'][name] = {'wall_time': time.perf_counter() - t0,
+                             'cpu_time': time.process_time() - c0,
+                             'peak_rss_mb': peak_rss_mb()}
+        return result
+
+    try:
+        if config['engine'] == 'matrix':
+            a = stage('input', d3a_opti_input_arrays, data)
+            del data
+            lp = stage('build', d3a_opti_matrix, a)
+            r['variables'] = lp['A_eq'].shape[1]
+            r['constraints'] = lp['A_eq'].shape[0]
+            lp = stage('solve', solve_matrix_model, lp, options)
+            stage('extract', d3a_opti_matrix_solution, lp, 'arrays')
+            r['objective'] = lp['objective']
+        else:
+            model_data = stage('input', d3a_opti_input, data)
+            del data
+            model_instance = stage('build', initialize_model, d3a_opti(), model_data)
+            del model_data
+            r['variables'] = model_instance.nvariables()
+            r['constraints'] = model_instance.nconstraints()
+            model_instance = stage('solve', solve_model, model_instance, None, solver, options)
+            stage('extract', d3a_opti_solution, model_instance)
+            r['objective'] = value(model_instance.total_cost)
+        r['error'] = None
+
+    except Exception as e:
+        r['error'] = '%s: %s' % (type(e).__name__, e)
+
+    return r
+
+
+
+def _environment():
+
+    env = {'python': platform.python_version(),
+           'platform': platform.platform(),
+           'pyomo': pyomo.version.version,
+           'numpy': np.__version__,
+           'pandas': pd.__version__,
+           'time': pd.Timestamp.now(tz='UTC').isoformat()}
+
+    try:
+        env['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        env['commit'] = None
+
+    return env
+
+
+
+def benchmark_scaling(members=(10, 50, 100), battery_shares=(0.5,), horizons_days=(1, 7), freqs=('15min',),
+                      engines=('pyomo',), solver='highs', options=None, output='benchmark_scaling.json'):
+
+    ## Example
+    # from benchmark import benchmark_scaling
+    #
+    # r = benchmark_scaling(members=[10, 100, 500], horizons_days=[7, 30, 365], engines=['pyomo', 'matrix'])
+
+    # Runs every combination of members, battery share, horizon and resolution
+    # and records wall/CPU time and peak RSS after the input, build, solve and
+    # extract stages, the model size and the objective. Failing configurations
+    # are recorded with their error. Results are written as JSON to output.
+
+    configs = []
+    for engine, n, share, days, freq in itertools.product(engines, members, battery_shares, horizons_days, freqs):
+        periods = int(pd.Timedelta(days=days)/pd.Timedelta(freq))
+        configs.append({'engine': engine, 'members': n, 'battery_share': share,
+                        'horizon_days': days, 'freq': freq, 'periods': periods})
+
+    results = {'environment': _environment(), 'solver': solver, 'options': options, 'runs': []}
+
+    for config in configs:
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                r = executor.submit(_scaling_run, config, solver, options).result()
+            except Exception as e:
+                # e.g. the worker was killed when running out of memory
+                r = dict(config, stages={}, error='%s: %s' % (type(e).__name__, e))
+
+        results['runs'].append(r)
+
+        if r['error'] is None:
+            print('%-6s %5d members %6d periods: %s' % (config['engine'], config['members'], config['periods'],
+                  '  '.join('%s %.2f s' % (k, v['wall_time']) for k, v in r['stages'].items())))
+        else:
+            print('%-6s %5d members %6d periods: %s' % (config['engine'], config['members'], config['periods'], r['error']))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+
+
+def _parse_year_rowwise(df):
+
+    # Previous Nord Pool parser with one Python call per hourly row, kept as reference
+
+    time_vector = pd.to_datetime(df.reset_index().apply(lambda r: '%s %s:00' % (r.iloc[0], r.iloc[1][:2]), axis=1), format="%d-%m-%Y %H:%M")
+    df.set_index(time_vector, inplace=True)
+
+    df.dropna(inplace=True, how='all')
+    df.index = df.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
+    df = df.sort_index()
+    df.index.name = 'Timestamp'
+
+    return df
+
+
+
+def benchmark_nordpool_parse(dataset='elspot-prices', years=range(2015, 2022), currency='EUR', repeat=3):
+
+    ## Example
+    # import nordpool
+    # from benchmark import benchmark_nordpool_parse
+    #
+    # nordpool.DATA_URLS['elspot-prices'] = 'nordpool_files/elspot-prices_%s_hourly_%s.xls' # optional local files
+    # r = benchmark_nordpool_parse('elspot-prices', years=range(2015, 2022))
+
+    # Parse time of the row-wise and the vectorized timestamp parsing on the same
+    # downloaded yearly tables, the download itself is not timed
+
+    tables = []
+    for year in years:
+        url = nordpool.DATA_URLS[dataset] % ((year,) if dataset.endswith('volumes') else (year, currency.lower()))
+        tables.append(pd.read_html(url, skiprows=2, header=nordpool.HEADER_ROWS[dataset], index_col=[0, 1], decimal=',', thousands=' ')[0])
+
+    r = {'dataset': dataset, 'years': list(years), 'rows': sum(len(t) for t in tables)}
+
+    for name, parse in [('rowwise', _parse_year_rowwise), ('vectorized', nordpool._parse_year)]:
+        times = []
+        for i in range(repeat):
+            copies = [t.copy() for t in tables]
+            t0 = time.perf_counter()
+            parsed = pd.concat([parse(t) for t in copies], sort=True)
+            times.append(time.perf_counter() - t0)
+        r[name + '_time'] = min(times)
+        r[name + '_rows'] = len(parsed)
+
+    r['speedup'] = r['rowwise_time']/r['vectorized_time']
+
+    print('%s %d rows: rowwise %.3f s, vectorized %.3f s, speedup %.1fx' % (dataset, r['rows'], r['rowwise_time'], r['vectorized_time'], r['speedup']))
+
+    return r
@@ -0,0 +1,462 @@
+import os
+import time
+import numpy as np
+import scipy.sparse as sp
+import multiprocessing as mp
+
+from scipy.linalg import cholesky_banded, cho_solve_banded
+
+from d3a_matrix import d3a_opti_matrix, solve_matrix_model, variables_solution, model_data_arrays, CARBON_PRICE_SCALE
+
+
+
+# ADMM decomposition of the community LP by member (sharing problem)
+#
+# Members are only coupled through energy_balance_grid, the community trade
+# y = PL2_SELL - PL2_BUY equals the sum of the member net injections
+# x = PL1_SELL - PL1_BUY. Every member with battery power solves its own
+# subproblem, a QP over its battery operation with the proximal term
+# rho/2*||x - v||^2, in a worker process that keeps its member block between
+# iterations. Members without battery power have a fixed net injection and are
+# added to the community trade. The community step has a closed form per period
+# with a = (mmr + gf)*dt the cost of buying and b = (gf + cf - fit)*dt the cost
+# of selling: y = w - b*N/rho if positive, y = w + a*N/rho if negative, 0 otherwise.
+# The members are coordinated by the price of the grid balance, -rho*u with the
+# scaled dual u, which is the value of member net injection.
+#
+# Residuals per iteration: primal ||sum(x) - y|| and dual rho*||y - y_previous||,
+# the iterations stop when both relative to ||y|| are below tol.
+
+
+
+def _member_specs(a):
+
+    # Subproblem data of the members with battery power, net injection of the others
+
+    H, D, G, B = list(a['H']), list(a['D']), list(a['G']), list(a['B'])
+    nT = len(a['T'])
+
+    d_pos = {d: i for i, d in enumerate(D)}
+    g_pos = {g: i for i, g in enumerate(G)}
+    b_pos = {b: i for i, b in enumerate(B)}
+
+    net = np.zeros((nT, len(H)))
+    for j, h in enumerate(H):
+        if h in g_pos:
+            net[:, j] += a['generation'][:, g_pos[h]]
+        if h in d_pos:
+            net[:, j] -= a['demand'][:, d_pos[h]]
+
+    specs = []
+    fixed = []
+    for j, h in enumerate(H):
+        i = b_pos.get(h)
+        if i is not None and (a['battery_charge_max'][i] > 0 or a['battery_discharge_max'][i] > 0):
+            specs.append({'member': j,
+                          'battery': i,
+                          'net': net[:, j],
+                          'community_fee': np.asarray(a['community_fee'], dtype=float),
+                          'dt': a['dt'],
+                          'min_level': max(a['battery_min_level'][i], 0.0),
+                          'capacity': a['battery_capacity'][i],
+                          'charge_max': a['battery_charge_max'][i],
+                          'discharge_max': a['battery_discharge_max'][i],
+                          'efficiency_charge': a['battery_efficiency_charge'][i],
+                          'efficiency_discharge': a['battery_efficiency_discharge'][i],
+                          'bel_ini_level': a['bel_ini_level'][i]})
+        else:
+            fixed.append(j)
+
+    return specs, fixed, net
+
+
+
+class _MemberBlock:
+
+    # Member subproblems of a block of members solved together with an operator
+    # splitting (OSQP) of the block diagonal QP. The columns of a member are
+    # X (net injection), BUY, BEL, B_IN, B_OUT of every period in turn, so the KKT
+    # matrix is banded and factorized once, and every solve starts from the previous solution.
+    # Rows of a member: house balance, purchase, battery energy balance, bounds of BUY, BEL, B_IN, B_OUT
+
+    def __init__(self, specs, sigma = 1e-6, rho = 1.0, alpha = 1.6):
+
+        self.specs = specs
+        self.nT = len(specs[0]['net'])
+        self.alpha = alpha
+
+        blocks = [self._member_rows(spec) for spec in specs]
+        self.A = sp.block_diag([b[0] for b in blocks], format='csr')
+        self.AT = self.A.T.tocsr()
+        self.lower = np.concatenate([b[1] for b in blocks])
+        self.upper = np.concatenate([b[2] for b in blocks])
+
+        # Equality rows with a higher step size
+        self.rho = np.where(self.lower == self.upper, 1e3*rho, rho)
+
+        n = self.A.shape[1]
+        self.P = np.zeros(n)
+        self.P[::5] = 1.0
+        self.sigma = sigma
+
+        # Lower band of the KKT matrix, the battery energy balance spans 7 columns
+        K = sp.diags(self.P + sigma) + self.AT @ sp.diags(self.rho) @ self.A
+        band = np.zeros((8, n))
+        for d in range(8):
+            band[d, :n - d] = K.diagonal(-d)
+        self.kkt = cholesky_banded(band, lower=True)
+
+        self.x = np.zeros(n)
+        self.z = np.clip(np.zeros(len(self.lower)), self.lower, self.upper)
+        self.y = np.zeros(len(self.lower))
+        self.iterations = 0
+
+
+    def _member_rows(self, spec):
+
+        nT = self.nT
+        dt = spec['dt']
+        t = np.arange(nT)
+        X, BUY, BEL, B_IN, B_OUT = [5*t + k for k in range(5)]
+
+        rows = []
+        cols = []
+        vals = []
+
+        # House balance X - B_OUT + B_IN = net
+        rows += [t, t, t]
+        cols += [X, B_OUT, B_IN]
+        vals += [np.ones(nT), -np.ones(nT), np.ones(nT)]
+
+        # Member purchase X + BUY >= 0
+        rows += [nT + t, nT + t]
+        cols += [X, BUY]
+        vals += [np.ones(nT), np.ones(nT)]
+
+        # Battery energy balance
+        rows += [2*nT + t, 2*nT + t[1:], 2*nT + t, 2*nT + t]
+        cols += [BEL, BEL[:-1], B_IN, B_OUT]
+        vals += [np.ones(nT), -np.ones(nT - 1), np.full(nT, -spec['efficiency_charge']*dt), np.full(nT, dt/spec['efficiency_discharge'])]
+
+        # Bounds
+        rows += [3*nT + np.arange(4*nT)]
+        cols += [np.concatenate([BUY, BEL, B_IN, B_OUT])]
+        vals += [np.ones(4*nT)]
+
+        A = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(7*nT, 5*nT))
+
+        soc = np.zeros(nT)
+        soc[0] = spec['bel_ini_level']
+
+        lower = np.concatenate([spec['net'], np.zeros(nT), soc, np.zeros(nT), np.full(nT, spec['min_level']), np.zeros(2*nT)])
+        upper = np.concatenate([spec['net'], np.full(nT, np.inf), soc, np.full(nT, np.inf), np.full(nT, spec['capacity']),
+                                np.full(nT, spec['charge_max']), np.full(nT, spec['discharge_max'])])
+
+        return A, lower, upper
+
+
+    def solve(self, v, rho, tol, max_iter = 1000):
+
+        # Net injections (T, members) minimizing the member cost/rho + 1/2*||x - v||^2
+
+        nT = self.nT
+        q = np.zeros((len(self.specs), nT, 5))
+        q[:, :, 0] = -v.T
+        q[:, :, 1] = [spec['community_fee']*spec['dt']/rho for spec in self.specs]
+        q = q.ravel()
+
+        x, z, y = self.x, self.z, self.y
+        a = self.alpha
+        for k in range(max_iter):
+            x_new = cho_solve_banded((self.kkt, True), self.sigma*x - q + self.AT @ (self.rho*z - y))
+            z_tilde = self.A @ x_new
+            x = a*x_new + (1 - a)*x
+            z_relaxed = a*z_tilde + (1 - a)*z
+            z = np.clip(z_relaxed + y/self.rho, self.lower, self.upper)
+            y = y + self.rho*(z_relaxed - z)
+
+            if k % 10 == 9:
+                primal = np.max(np.abs(self.A @ x - z))
+                dual = np.max(np.abs(self.P*x + q + self.AT @ y))
+                if primal <= tol and dual <= tol:
+                    break
+
+        self.x, self.z, self.y = x, z, y
+        self.iterations += k + 1
+
+        return x.reshape(len(self.specs), nT, 5)[:, :, 0].T.copy()
+
+
+    def variables(self):
+
+        # (T, members) arrays of B_IN, B_OUT of the last solve
+
+        x = self.x.reshape(len(self.specs), self.nT, 5)
+        B_IN = np.clip(x[:, :, 3].T, 0.0, [spec['charge_max'] for spec in self.specs])
+        B_OUT = np.clip(x[:, :, 4].T, 0.0, [spec['discharge_max'] for spec in self.specs])
+
+        return {'B_IN': B_IN, 'B_OUT': B_OUT}
+
+
+
+def _worker(conn, specs):
+
+    block = _MemberBlock(specs)
+    while True:
+        message = conn.recv()
+        try:
+            if message[0] == 'solve':
+                conn.send(block.solve(message[1], message[2], message[3]))
+            elif message[0] == 'variables':
+                conn.send(block.variables())
+            else:
+                break
+        except Exception as e:
+            conn.send(e)
+
+
+
+class _Workers:
+
+    # Member blocks in worker processes, or in this process when workers <= 1
+
+    def __init__(self, specs, workers):
+
+        self.splits = np.array_split(np.arange(len(specs)), max(min(workers, len(specs)), 1))
+        self.local = None
+        self.processes = []
+        self.conns = []
+
+        if workers <= 1:
+            self.local = _MemberBlock(specs)
+            return
+
+        ctx = mp.get_context('spawn')
+        for s in self.splits:
+            parent, child = ctx.Pipe()
+            p = ctx.Process(target=_worker, args=(child, [specs[i] for i in s]), daemon=True)
+            p.start()
+            self.processes.append(p)
+            self.conns.append(parent)
+
+
+    def solve(self, v, rho, tol):
+
+        if self.local is not None:
+            return self.local.solve(v, rho, tol)
+
+        for conn, s in zip(self.conns, self.splits):
+            conn.send(('solve', v[:, s], rho, tol))
+        results = [self._result(conn) for conn in self.conns]
+
+        return np.column_stack(results)
+
+
+    def variables(self):
+
+        if self.local is not None:
+            return self.local.variables()
+
+        for conn in self.conns:
+            conn.send(('variables',))
+        results = [self._result(conn) for conn in self.conns]
+
+        return {k: np.column_stack([r[k] for r in results]) for k in results[0]}
+
+
+    def _result(self, conn):
+
+        r = conn.recv()
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+    def close(self):
+
+        for conn in self.conns:
+            conn.send(('stop',))
+        for p in self.processes:
+            p.join()
+
+
+
+def _battery_operation(B_IN, B_OUT, specs):
+
+    # Battery levels of the (T, members) charging and discharging, the power is
+    # reduced where the level would leave its bounds by the subproblem tolerance
+
+    dt = specs[0]['dt']
+    eta_c = np.array([spec['efficiency_charge'] for spec in specs])
+    eta_d = np.array([spec['efficiency_discharge'] for spec in specs])
+    lower = np.array([spec['min_level'] for spec in specs])
+    upper = np.array([spec['capacity'] for spec in specs])
+
+    B_IN = B_IN.copy()
+    B_OUT = B_OUT.copy()
+    BEL = np.empty_like(B_IN)
+    level = np.array([spec['bel_ini_level'] for spec in specs], dtype=float)
+    for t in range(B_IN.shape[0]):
+        bel = level + eta_c*dt*B_IN[t] - dt/eta_d*B_OUT[t]
+        B_IN[t] = np.maximum(B_IN[t] - np.maximum(bel - upper, 0.0)/(eta_c*dt), 0.0)
+        B_OUT[t] = np.maximum(B_OUT[t] - np.maximum(lower - bel, 0.0)*eta_d/dt, 0.0)
+        level = level + eta_c*dt*B_IN[t] - dt/eta_d*B_OUT[t]
+        BEL[t] = level
+
+    return B_IN, B_OUT, BEL
+
+
+
+def d3a_opti_admm(model_data, rho = None, tol = 1e-3, max_iter = 1000, adaptive = False, workers = None, compare = False, options = None, mode = 'dict', verbose = False):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_arrays
+    # from d3a_admm import d3a_opti_admm
+    #
+    # a = d3a_opti_input_arrays(data)
+    # s, stats = d3a_opti_admm(a, tol = 1e-3, workers = 8, compare = True)
+    #
+    # s has the structure of d3a_opti_solution(), the community trade is the sum of the member trades
+    # stats: 'iterations', 'converged', 'primal_residual', 'dual_residual' (per iteration), 'rho',
+    #        'objective', 'prices' (value of member net injection per period, EUR/kWh) and
+    #        'monolithic_objective', 'gap' when compare=True
+    # tol: relative primal and dual residual, rho: penalty (EUR/kW), by default from the tariffs
+    # adaptive: rho is doubled/halved when one residual is 10 times the other
+    # workers: worker processes for the member subproblems, 1 solves them in this process
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    nT = len(a['T'])
+    dt = a['dt']
+    mmr, fit, cf, gf, ce = [np.asarray(a[p], dtype=float) for p in ['marketmakerrate', 'feedintariff', 'community_fee', 'grid_fee', 'carbon_emission']]
+
+    # Community cost of buying and selling per kW with the emissions at carbon_price
+    carbon = a.get('carbon_price', 0.0)*CARBON_PRICE_SCALE*ce
+    cost_buy = (mmr + gf + carbon)*dt
+    cost_sell = (gf + cf - fit - carbon)*dt
+    if np.any(cost_buy + cost_sell < 0) or np.any(cf < 0):
+        raise ValueError('The community LP is unbounded for these tariffs')
+
+    specs, fixed, net = _member_specs(a)
+    N = len(specs)
+    c = net[:, fixed].sum(axis=1)
+
+    # Default penalty from the trade cost per kW of net injection
+    if rho is None:
+        rho = 0.25*np.mean(cost_buy + cost_sell)/max(np.mean(np.abs(net)), 1e-9)
+
+    stats = {'members': len(a['H']), 'subproblems': N, 'primal_residual': [], 'dual_residual': [], 'converged': False}
+    t0 = time.perf_counter()
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    variables = None
+    if N > 0:
+        pool = _Workers(specs, workers)
+        try:
+            x = np.column_stack([spec['net'] for spec in specs])
+            u = np.zeros(nT)
+            y = x.sum(axis=1)
+            z = y/N
+            inner_tol = 1e-3
+
+            for k in range(max_iter):
+                x_mean = x.mean(axis=1)
+                x = pool.solve(x - x_mean[:, None] + (z - u)[:, None], rho, inner_tol)
+                x_mean = x.mean(axis=1)
+
+                # Community step for q = N*z + c, the total trade with the fixed members
+                q = N*(u + x_mean) + c
+                q = np.where(q - cost_sell*N/rho > 0, q - cost_sell*N/rho, np.where(q + cost_buy*N/rho < 0, q + cost_buy*N/rho, 0.0))
+                y_previous = y
+                y = q - c
+                z = y/N
+                u = u + x_mean - z
+
+                primal = np.linalg.norm(x.sum(axis=1) - y)
+                dual = rho*np.linalg.norm(y - y_previous)
+                stats['primal_residual'].append(primal)
+                stats['dual_residual'].append(dual)
+
+                if verbose:
+                    print('%4d primal %.3e dual %.3e rho %.3e' % (k + 1, primal, dual, rho))
+
+                scale = max(np.linalg.norm(y), 1e-9)
+                if primal <= tol*scale and dual <= tol*rho*scale:
+                    stats['converged'] = True
+                    break
+
+                # Subproblems are solved more accurately as the residuals decrease
+                inner_tol = min(inner_tol, max(0.1*min(primal, dual/rho)/np.sqrt(nT*N), 1e-8))
+
+                if adaptive and primal > 10*dual:
+                    rho *= 2
+                    u /= 2
+                elif adaptive and dual > 10*primal:
+                    rho /= 2
+                    u *= 2
+
+            variables = pool.variables()
+        finally:
+            pool.close()
+
+    stats['iterations'] = len(stats['primal_residual'])
+    stats['rho'] = rho
+    stats['time'] = time.perf_counter() - t0
+
+
+    ## SOLUTION
+    # Battery operation of the last iteration, member trades from the house balance
+    # and the community trade from the member trades, so every constraint holds exactly
+    H, B = list(a['H']), list(a['B'])
+    BEL = np.repeat(np.asarray(a['bel_ini_level'], dtype=float)[None, :], nT, axis=0)
+    B_IN = np.zeros((nT, len(B)))
+    B_OUT = np.zeros((nT, len(B)))
+    injection = net.copy()
+    if N > 0:
+        members = [spec['member'] for spec in specs]
+        batteries = [spec['battery'] for spec in specs]
+        b_in, b_out, bel = _battery_operation(variables['B_IN'], variables['B_OUT'], specs)
+        B_IN[:, batteries] = b_in
+        B_OUT[:, batteries] = b_out
+        BEL[:, batteries] = bel
+        injection[:, members] += b_out - b_in
+
+    buy = np.maximum(-injection, 0.0)
+    sell = np.maximum(injection, 0.0)
+    trade = injection.sum(axis=1)
+    PL2_SELL = np.maximum(trade, 0.0)
+    PL2_BUY = np.maximum(-trade, 0.0)
+
+    v = dict()
+    v['PL1_BUY'] = buy
+    v['PL1_SELL'] = sell
+    v['PL2_BUY'] = PL2_BUY
+    v['PL2_SELL'] = PL2_SELL
+    v['BEL'] = BEL
+    v['B_IN'] = B_IN
+    v['B_OUT'] = B_OUT
+    v['COST_ENERGY'] = (mmr*PL2_BUY - fit*PL2_SELL)*dt
+    v['COST_GRID'] = cf*buy.sum(axis=1)*dt + gf*PL2_BUY*dt + (gf + cf)*PL2_SELL*dt
+    v['CO2'] = (PL2_BUY - PL2_SELL)*ce*dt
+
+    stats['objective'] = float(np.sum(v['COST_ENERGY'] + v['COST_GRID']) + a.get('carbon_price', 0.0)*CARBON_PRICE_SCALE*np.sum(v['CO2']))
+    stats['prices'] = -rho*u/dt if N > 0 else np.zeros(nT)
+
+
+    ## MONOLITHIC REFERENCE
+    if compare:
+        t0 = time.perf_counter()
+        lp = solve_matrix_model(d3a_opti_matrix(a), options)
+        stats['monolithic_time'] = time.perf_counter() - t0
+        stats['monolithic_objective'] = lp['objective']
+        if lp['objective'] is not None:
+            stats['gap'] = (stats['objective'] - lp['objective'])/max(abs(lp['objective']), 1e-9)
+
+    s = variables_solution(v, H, B, mode)
+
+    return s, stats
@@ -0,0 +1,169 @@
+import time
+import numpy as np
+from pyomo.environ import value
+
+from d3a_opti import d3a_opti, initialize_model, solve_model, model_variables
+from d3a_matrix import d3a_opti_matrix, solve_matrix_model, matrix_variables, variables_solution
+from d3a_matrix import model_data_arrays, arrays_model_data, BATTERY_DEFAULTS
+
+
+
+# Member aggregation for large communities
+#
+# A member without battery power has a fixed net injection n = generation - demand.
+# With community_fee >= 0 its optimal trades are PL1_SELL = max(n, 0) and
+# PL1_BUY = max(-n, 0), and only their sums over the members enter
+# energy_balance_grid and grid_cost. All such members are replaced by two pseudo
+# members, AGGREGATE_BUY with the summed demand and AGGREGATE_SELL with the summed
+# generation, which gives the same optimal cost and community variables. The
+# member variables are restored exactly from the input data afterwards.
+
+
+AGGREGATE_BUY = 'aggregate_buy'
+AGGREGATE_SELL = 'aggregate_sell'
+
+
+
+def aggregate_members(model_data):
+
+    ## Example
+    # from d3a_aggregate import aggregate_members, disaggregate_variables
+    # from d3a_matrix import d3a_opti_matrix, solve_matrix_model, matrix_variables
+    #
+    # r, reduction = aggregate_members(model_data)
+    # lp = solve_matrix_model(d3a_opti_matrix(r))
+    # variables = disaggregate_variables(matrix_variables(lp), reduction)
+
+    # r: reduced array input, reduction: data for disaggregate_variables()
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    if np.any(a['community_fee'] < 0):
+        raise ValueError('Member aggregation needs community_fee >= 0')
+
+    H, D, G, B = list(a['H']), list(a['D']), list(a['G']), list(a['B'])
+
+    # Members with battery power are kept
+    powered = (a['battery_charge_max'] > 0) | (a['battery_discharge_max'] > 0)
+    kept_batteries = [b for b, p in zip(B, powered) if p]
+    kept_set = set(kept_batteries)
+    kept = [h for h in H if h in kept_set]
+    aggregated = [h for h in H if h not in kept_set]
+
+    net = _net_injection(a, aggregated)
+
+    r = dict(a)
+    r['H'] = kept + [AGGREGATE_BUY, AGGREGATE_SELL]
+    r['D'] = [d for d in D if d in kept_set] + [AGGREGATE_BUY]
+    r['G'] = [g for g in G if g in kept_set] + [AGGREGATE_SELL]
+    r['B'] = kept_batteries
+
+    d_index = [i for i, d in enumerate(D) if d in kept_set]
+    g_index = [i for i, g in enumerate(G) if g in kept_set]
+    r['demand'] = np.column_stack([a['demand'][:, d_index], np.maximum(-net, 0.0).sum(axis=1)])
+    r['generation'] = np.column_stack([a['generation'][:, g_index], np.maximum(net, 0.0).sum(axis=1)])
+
+    b_index = np.flatnonzero(powered)
+    for p in BATTERY_DEFAULTS:
+        r[p] = np.asarray(a[p])[b_index]
+
+    reduction = {'a': a, 'kept': kept, 'aggregated': aggregated, 'batteries': kept_batteries}
+
+    return r, reduction
+
+
+
+def _net_injection(a, members):
+
+    # (T, members) generation - demand
+
+    net = np.zeros((len(a['T']), len(members)))
+    D = {d: i for i, d in enumerate(a['D'])}
+    G = {g: i for i, g in enumerate(a['G'])}
+    for j, h in enumerate(members):
+        if h in G:
+            net[:, j] += a['generation'][:, G[h]]
+        if h in D:
+            net[:, j] -= a['demand'][:, D[h]]
+
+    return net
+
+
+
+def disaggregate_variables(variables, reduction):
+
+    # (T, X) variables of the reduced model back on the members and batteries of the full model
+
+    a = reduction['a']
+    H, B = list(a['H']), list(a['B'])
+    nT = len(a['T'])
+
+    full = {v: variables[v] for v in ['COST_ENERGY', 'COST_GRID', 'PL2_BUY', 'PL2_SELL', 'CO2']}
+
+    position = {h: i for i, h in enumerate(H)}
+    kept = [position[h] for h in reduction['kept']]
+    aggregated = [position[h] for h in reduction['aggregated']]
+    net = _net_injection(a, reduction['aggregated'])
+
+    for v, trades in [('PL1_BUY', np.maximum(-net, 0.0)), ('PL1_SELL', np.maximum(net, 0.0))]:
+        x = np.zeros((nT, len(H)))
+        x[:, kept] = variables[v][:, :len(kept)]
+        x[:, aggregated] = trades
+        full[v] = x
+
+    # Batteries without power keep their initial level
+    reduced_B = {b: i for i, b in enumerate(reduction['batteries'])}
+    for v in ['BEL', 'B_IN', 'B_OUT']:
+        x = np.zeros((nT, len(B)))
+        if v == 'BEL':
+            x[:] = np.asarray(a['bel_ini_level'], dtype=float)[None, :]
+        for j, b in enumerate(B):
+            if b in reduced_B:
+                x[:, j] = variables[v][:, reduced_B[b]]
+        full[v] = x
+
+    return full
+
+
+
+def d3a_opti_aggregated(model_data, engine = 'matrix', solver = 'highs', options = None, mode = 'dict'):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_arrays
+    # from d3a_aggregate import d3a_opti_aggregated
+    #
+    # a = d3a_opti_input_arrays(data)
+    # s, stats = d3a_opti_aggregated(a, engine = 'matrix')
+    #
+    # engine = 'matrix'/'pyomo' (solver of solve_model())
+    # s has the structure of d3a_opti_solution() for all members
+
+    t0 = time.perf_counter()
+    r, reduction = aggregate_members(model_data)
+    a = reduction['a']
+
+    stats = {'members': len(a['H']), 'batteries': len(a['B']), 'model_members': len(r['H']), 'model_batteries': len(r['B'])}
+
+    if engine == 'matrix':
+        lp = solve_matrix_model(d3a_opti_matrix(r), options)
+        if lp['x'] is None:
+            raise RuntimeError('Solve failed: %s' % lp['message'])
+        variables = matrix_variables(lp)
+        stats['objective'] = lp['objective']
+        stats['rows'] = lp['A_eq'].shape[0]
+        stats['columns'] = lp['A_eq'].shape[1]
+    elif engine == 'pyomo':
+        model_instance = initialize_model(d3a_opti(), arrays_model_data(r))
+        model_instance = solve_model(model_instance, solver=solver, options=options)
+        variables = model_variables(model_instance)
+        stats['objective'] = value(model_instance.total_cost)
+    else:
+        raise ValueError('Unknown engine: %s' % engine)
+
+    s = variables_solution(disaggregate_variables(variables, reduction), a['H'], a['B'], mode)
+    stats['time'] = time.perf_counter() - t0
+
+    return s, stats
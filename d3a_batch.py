@@ -0,0 +1,171 @@
+import os
+import time
+import shutil
+import tempfile
+import traceback
+from multiprocessing import SimpleQueue
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from pyomo.common.tempfiles import TempfileManager
+
+from d3a_input import d3a_opti_input
+from d3a_opti import d3a_opti, initialize_model, solve_model, d3a_opti_solution
+
+
+
+# Batch solver for many communities / scenarios
+#
+# Every scenario is an input dictionary as consumed by d3a_opti_input() and runs
+# the full d3a_opti_input -> initialize_model -> solve_model -> d3a_opti_solution
+# chain in a worker process. Each scenario gets its own working directory for
+# the solver files, which is removed afterwards unless keepfiles=True.
+#
+# A worker process that dies (solver crash, out of memory) breaks the pool and
+# every unfinished scenario of it. Workers report the scenarios they start, only
+# the scenarios that were running when the pool broke are suspects, the queued
+# ones are resubmitted on the next shared pool as they were. A scenario that was
+# running in BROKEN_SHARED broken pools is solved in a pool of its own, next to
+# the shared pool and the other isolated scenarios, and gets the BrokenProcessPool
+# error if it breaks that pool too.
+
+
+# Broken shared pools a scenario was running in before it is solved on its own
+BROKEN_SHARED = 2
+
+# Queue of the started scenarios in the worker processes
+_started = None
+
+
+
+def _init_worker(started):
+
+    global _started
+    _started = started
+
+
+
+def _solve_scenario(index, data, solver, options, workdir, keepfiles):
+
+    t0 = time.perf_counter()
+
+    if _started is not None:
+        _started.put(index)
+
+    scenario_dir = tempfile.mkdtemp(prefix='d3a_scenario_%s_' % index, dir=workdir)
+    cwd = os.getcwd()
+
+    result = {'index': index, 'solution': None, 'error': None, 'workdir': scenario_dir}
+
+    try:
+        os.chdir(scenario_dir)
+        TempfileManager.tempdir = scenario_dir
+
+        model_data = d3a_opti_input(data)
+        model_instance = initialize_model(d3a_opti(), model_data)
+
+        model_instance = solve_model(model_instance, solver=solver, options=options, keepfiles=keepfiles)
+
+        result['solution'] = d3a_opti_solution(model_instance)
+
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    finally:
+        os.chdir(cwd)
+        TempfileManager.tempdir = None
+        if not keepfiles:
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+            result['workdir'] = None
+
+    result['time'] = time.perf_counter() - t0
+
+    return result
+
+
+
+def solve_batch(inputs, workers=None, solver='highs', options=None, workdir=None, keepfiles=False):
+
+    ## Example
+    # from d3a_batch import solve_batch
+    #
+    # inputs = [data_1, data_2, ...] # or {'scenario name': data, ...}
+    # for r in solve_batch(inputs, workers=64, solver='highs'):
+    #     if r['error'] is None:
+    #         s = r['solution']
+    #     else:
+    #         print(r['index'], r['error'])
+
+    # Results are yielded in order of completion as dictionaries with
+    # 'index' (list position or dictionary key), 'solution', 'error', 'time' and 'workdir'
+    # Scenarios that crash their worker process have the BrokenProcessPool traceback as 'error'
+    # solver=None uses the glpk default of solve_model(), which takes no options
+
+
+    if solver is None and options is not None:
+        raise ValueError('options need a named solver, solver=None uses the glpk default of solve_model()')
+
+    if isinstance(inputs, dict):
+        items = list(inputs.items())
+    else:
+        items = list(enumerate(inputs))
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+
+    started = SimpleQueue()
+    broken = {index: 0 for index, data in items}
+    while len(items) > 0:
+
+        shared = [(index, data) for index, data in items if broken[index] < BROKEN_SHARED]
+        isolated = [(index, data) for index, data in items if broken[index] >= BROKEN_SHARED]
+
+        # Shared pool and one single worker pool per isolated scenario, all running at once
+        pools = [(shared, workers, False)] if len(shared) > 0 else []
+        pools += [([item], 1, True) for item in isolated[:workers]]
+        items = isolated[workers:]
+
+        while not started.empty():
+            started.get()
+        started_round = set()
+        retry = []
+
+        executors = []
+        futures = {}
+        try:
+            for pool_items, pool_workers, alone in pools:
+                executor = ProcessPoolExecutor(max_workers=pool_workers, initializer=_init_worker, initargs=(started,))
+                executors.append(executor)
+                for index, data in pool_items:
+                    future = executor.submit(_solve_scenario, index, data, solver, options, workdir, keepfiles)
+                    futures[future] = (index, data, alone)
+
+            for future in as_completed(futures):
+                while not started.empty():
+                    started_round.add(started.get())
+
+                index, data, alone = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    if not alone:
+                        retry.append((index, data))
+                        continue
+                    result = {'index': index, 'solution': None, 'error': traceback.format_exc(), 'workdir': None, 'time': None}
+
+                yield result
+
+        finally:
+            for executor in executors:
+                executor.shutdown()
+
+        # Scenarios started in the broken shared pool, all of them if none was reported
+        while not started.empty():
+            started_round.add(started.get())
+        suspects = [index for index, data in retry if index in started_round] or [index for index, data in retry]
+        for index in suspects:
+            broken[index] += 1
+        items += retry
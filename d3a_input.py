@@ -2,8 +2,23 @@ import pandas as pd
 from pandas.tseries.frequencies import to_offset
 import numpy as np
 
+from d3a_monitor import monitor_stage
 
-def d3a_opti_input(data):    
+
+def d3a_opti_input(data, monitor=None):
+
+    # monitor: optional d3a_monitor.PipelineMonitor
+
+    with monitor_stage(monitor, 'input') as record:
+        model_data = _d3a_opti_input(data)
+        record['periods'] = len(model_data[None]['T'])
+        record['members'] = len(model_data[None]['H'])
+
+    return model_data
+
+
+
+def _d3a_opti_input(data):    
     
     loc_names = list(data.keys())
 
@@ -57,16 +72,11 @@ def d3a_opti_input(data):
         bel_fin_level.update({nm: data[loc_name]['battery']['min soc']})
 
 
-    # Create sets
-    demand_members = {b for a, b in list(demand.keys())}
-    generation_members = {b for a, b in list(generation.keys())}
-    battery_members = battery_capacity.keys()
-    all_members = demand_members | generation_members | battery_members
-    
-    demand_members = list(demand_members)
-    generation_members = list(generation_members)
-    battery_members = list(battery_members)
-    all_members = list(all_members)
+    # Create sets, members in the order of the data dictionary
+    demand_members = list(dict.fromkeys(b for a, b in demand.keys()))
+    generation_members = list(dict.fromkeys(b for a, b in generation.keys()))
+    battery_members = list(battery_capacity.keys())
+    all_members = list(dict.fromkeys(demand_members + generation_members + battery_members))
     
 
     # Create model data input dictionary
@@ -100,4 +110,126 @@ def d3a_opti_input(data):
         'dt': resolution,
     }}  
 
-    return model_data
\ No newline at end of file
+    return model_data
+
+
+
+# Tariff columns and battery fields of the input data, keyed by model parameter name
+TARIFF_FIELDS = {'marketmakerrate': 'market maker rate',
+                 'feedintariff': 'feed in tariff',
+                 'community_fee': 'community fee',
+                 'grid_fee': 'grid fee',
+                 'carbon_emission': 'carbon emission factor'}
+
+BATTERY_FIELDS = {'battery_min_level': 'min soc',
+                  'battery_capacity': 'capacity',
+                  'battery_charge_max': 'charging power',
+                  'battery_discharge_max': 'discharging power',
+                  'battery_efficiency_charge': 'charging efficiency',
+                  'battery_efficiency_discharge': 'discharging efficiency'}
+
+
+
+def d3a_opti_input_arrays(data, monitor=None):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_arrays
+    # from d3a_matrix import d3a_opti_matrix
+    #
+    # a = d3a_opti_input_arrays(data)
+    # lp = d3a_opti_matrix(a)
+
+    # Same data dictionary as d3a_opti_input() but returns (periods x members) 
+    # NumPy arrays instead of (period, member) keyed dictionaries.
+    # Members are in the order of the data dictionary.
+
+    with monitor_stage(monitor, 'input') as record:
+        a = _d3a_opti_input_arrays(data)
+        record['periods'] = len(a['T'])
+        record['members'] = len(a['H'])
+
+    return a
+
+
+
+def _d3a_opti_input_arrays(data):
+
+    loc_names = list(data.keys())
+
+    prd = data[loc_names[0]]['timestamps']
+
+    a = dict()
+    a['T'] = np.arange(1, len(prd)+1)
+    a['H'] = loc_names
+    a['D'] = loc_names
+    a['G'] = loc_names
+    a['B'] = loc_names
+
+    a['demand'] = np.column_stack([np.asarray(data[nm]['demand'], dtype=float) for nm in loc_names])
+    a['generation'] = np.column_stack([np.asarray(data[nm]['generation'], dtype=float) for nm in loc_names])
+
+    for p, field in TARIFF_FIELDS.items():
+        a[p] = np.asarray(data[loc_names[0]][field], dtype=float)
+
+    for p, field in BATTERY_FIELDS.items():
+        a[p] = np.array([data[nm]['battery'][field] for nm in loc_names], dtype=float)
+
+    a['bel_ini_level'] = a['battery_min_level'].copy()
+    a['bel_fin_level'] = a['battery_min_level'].copy()
+
+    a['dt'] = pd.to_timedelta(to_offset(pd.infer_freq(prd))).total_seconds()/3600
+
+    return a
+
+
+
+def d3a_opti_input_frames(demand, generation, tariffs, batteries):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_frames
+    #
+    # demand, generation: DataFrames indexed by timestamp with one column per member
+    # tariffs: DataFrame indexed by timestamp with columns 'market maker rate', 'feed in tariff',
+    #          'community fee', 'grid fee', 'carbon emission factor'
+    # batteries: DataFrame indexed by member with columns 'min soc', 'capacity', 'charging power',
+    #            'discharging power', 'charging efficiency', 'discharging efficiency'
+    #
+    # a = d3a_opti_input_frames(demand, generation, tariffs, batteries)
+
+    # Members are the columns of demand and generation and the battery rows, members
+    # without demand, generation or battery rows get zero demand, zero generation and an empty battery.
+    # generation and tariffs are aligned on the timestamps of demand.
+
+    members = list(dict.fromkeys(list(demand.columns) + list(generation.columns) + list(batteries.index)))
+
+    generation = generation.reindex(columns=members, fill_value=0.0).reindex(index=demand.index)
+    tariffs = tariffs.reindex(index=demand.index)
+    for name, df in [('generation', generation), ('tariffs', tariffs[list(TARIFF_FIELDS.values())])]:
+        missing = df.index[df.isna().any(axis=1)]
+        if len(missing) > 0:
+            raise ValueError('%s has no values for %d timestamps of demand, first %s' % (name, len(missing), missing[0]))
+
+    a = dict()
+    a['T'] = np.arange(1, len(demand.index)+1)
+    a['H'] = members
+    a['D'] = members
+    a['G'] = members
+    a['B'] = members
+
+    a['demand'] = demand.reindex(columns=members, fill_value=0.0).to_numpy(dtype=float)
+    a['generation'] = generation.to_numpy(dtype=float)
+
+    for p, field in TARIFF_FIELDS.items():
+        a[p] = tariffs[field].to_numpy(dtype=float)
+
+    batteries = batteries.reindex(members)
+    for p, field in BATTERY_FIELDS.items():
+        default = 1.0 if 'efficiency' in field else 0.0
+        a[p] = batteries[field].fillna(default).to_numpy(dtype=float)
+
+    a['bel_ini_level'] = a['battery_min_level'].copy()
+    a['bel_fin_level'] = a['battery_min_level'].copy()
+
+    a['dt'] = pd.to_timedelta(to_offset(pd.infer_freq(demand.index))).total_seconds()/3600
+
+    return a
\ No newline at end of file
@@ -0,0 +1,483 @@
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.optimize import linprog
+
+
+
+# Matrix engine for the d3a_opti LP
+#
+# Builds the same LP as d3a_opti() directly as sparse coefficient matrices with
+# vectorized indexing over (T, H, B), skipping the Pyomo AbstractModel instance.
+# Variables are stacked in the order they are declared in d3a_opti(), each
+# (T, X) indexed variable laid out period-major: column = offset + t*len(X) + x.
+
+
+VARIABLES = ['COST_ENERGY', 'COST_GRID', 'PL1_BUY', 'PL1_SELL', 'PL2_BUY', 'PL2_SELL', 'BEL', 'B_IN', 'B_OUT', 'CO2']
+CONSTRAINTS = ['energy_cost', 'grid_cost', 'energy_balance_grid', 'energy_balance_house', 'battery_soc', 'carbon_emissions']
+
+BATTERY_DEFAULTS = {'battery_min_level': 0.0,
+                    'battery_capacity': 0.0,
+                    'battery_charge_max': 0.0,
+                    'battery_discharge_max': 0.0,
+                    'battery_efficiency_charge': 1.0,
+                    'battery_efficiency_discharge': 1.0,
+                    'bel_ini_level': 0.0}
+
+PERIOD_PARAMS = ['marketmakerrate', 'feedintariff', 'community_fee', 'grid_fee', 'carbon_emission']
+
+# carbon_price is in EUR/tCO2, CO2 in gCO2
+CARBON_PRICE_SCALE = 1e-6
+
+# scipy HiGHS names of the generic solver options, threads is not supported by scipy
+MATRIX_OPTIONS = {'time_limit': 'time_limit',
+                  'feasibility_tolerance': 'primal_feasibility_tolerance',
+                  'optimality_tolerance': 'dual_feasibility_tolerance'}
+
+# Solution keys of d3a_opti_solution() and the variables they are read from
+SOLUTION_VARIABLES = {'cost_energy': 'COST_ENERGY',
+                      'cost_grid': 'COST_GRID',
+                      'power_buy_community': 'PL2_BUY',
+                      'power_sell_community': 'PL2_SELL',
+                      'power_buy_member': 'PL1_BUY',
+                      'power_sell_member': 'PL1_SELL',
+                      'battery_soc_member': 'BEL',
+                      'battery_charge_member': 'B_IN',
+                      'battery_discharge_member': 'B_OUT',
+                      'carbon_emissions': 'CO2'}
+
+SOLUTION_COMMUNITY = ['cost_energy', 'cost_grid', 'power_buy_community', 'power_sell_community', 'carbon_emissions']
+SOLUTION_MEMBER = ['power_buy_member', 'power_sell_member']
+SOLUTION_BATTERY = ['battery_soc_member', 'battery_charge_member', 'battery_discharge_member']
+
+
+
+def model_data_arrays(model_data):
+
+    # Convert the d3a_opti_input() model data dictionary into NumPy arrays
+    # demand/generation become (T, D)/(T, G) arrays, period parameters (T,) arrays
+    # and battery parameters (B,) arrays ordered as the member sets
+
+    md = model_data[None]
+
+    periods = np.asarray(md['T'])
+    H = list(md['H'])
+    D = list(md['D'])
+    G = list(md['G'])
+    B = list(md['B'])
+
+    a = dict()
+    a['T'] = periods
+    a['H'] = H
+    a['D'] = D
+    a['G'] = G
+    a['B'] = B
+
+    demand = md['demand']
+    generation = md['generation']
+    a['demand'] = np.array([demand[t, d] for t in periods for d in D], dtype=float).reshape(len(periods), len(D))
+    a['generation'] = np.array([generation[t, g] for t in periods for g in G], dtype=float).reshape(len(periods), len(G))
+
+    for p in PERIOD_PARAMS:
+        a[p] = np.array([md[p][t] for t in periods], dtype=float)
+
+    for p, default in BATTERY_DEFAULTS.items():
+        a[p] = np.array([md.get(p, {}).get(b, default) for b in B], dtype=float)
+
+    a['dt'] = float(md['dt'][None])
+
+    if 'carbon_price' in md:
+        a['carbon_price'] = float(md['carbon_price'][None])
+
+    return a
+
+
+
+def arrays_model_data(a):
+
+    # Inverse of model_data_arrays(), model data dictionary for initialize_model()
+
+    periods = np.asarray(a['T'])
+    nT = len(periods)
+
+    md = dict()
+    md['T'] = periods
+    md['H'] = list(a['H'])
+    md['D'] = list(a['D'])
+    md['G'] = list(a['G'])
+    md['B'] = list(a['B'])
+
+    md['demand'] = dict(zip([(t, d) for t in periods for d in a['D']], np.asarray(a['demand']).ravel()))
+    md['generation'] = dict(zip([(t, g) for t in periods for g in a['G']], np.asarray(a['generation']).ravel()))
+
+    for p in PERIOD_PARAMS:
+        md[p] = dict(zip(periods, np.asarray(a[p])[:nT]))
+
+    for p in BATTERY_DEFAULTS:
+        md[p] = dict(zip(a['B'], a[p]))
+
+    md['dt'] = {None: a['dt']}
+
+    if 'carbon_price' in a:
+        md['carbon_price'] = {None: a['carbon_price']}
+
+    return {None: md}
+
+
+
+def slice_arrays(a, start, stop):
+
+    # Periods start:stop (0-based, stop exclusive) renumbered from 1 as in d3a_opti_input()
+
+    w = dict(a)
+    w['T'] = np.arange(1, stop - start + 1)
+    w['demand'] = a['demand'][start:stop]
+    w['generation'] = a['generation'][start:stop]
+    for p in PERIOD_PARAMS:
+        w[p] = a[p][start:stop]
+
+    return w
+
+
+
+def _variable_layout(nT, nH, nB):
+
+    size = {'COST_ENERGY': nT, 'COST_GRID': nT,
+            'PL1_BUY': nT*nH, 'PL1_SELL': nT*nH,
+            'PL2_BUY': nT, 'PL2_SELL': nT,
+            'BEL': nT*nB, 'B_IN': nT*nB, 'B_OUT': nT*nB,
+            'CO2': nT}
+
+    layout = {}
+    offset = 0
+    for v in VARIABLES:
+        layout[v] = offset
+        offset += size[v]
+
+    return layout, offset
+
+
+
+def d3a_opti_matrix(model_data):
+
+    ## Example
+    # from d3a_input import d3a_opti_input
+    # from d3a_matrix import d3a_opti_matrix, solve_matrix_model, d3a_opti_matrix_solution
+    #
+    # model_data = d3a_opti_input(data)
+    # lp = d3a_opti_matrix(model_data)
+    # lp = solve_matrix_model(lp)
+    # s = d3a_opti_matrix_solution(lp)
+
+    # Optional keys of the array input
+    # period_weight: (T,) weights of the period costs in the objective
+    # soc_cycle:     battery_soc is cyclic over every soc_cycle periods instead of starting from bel_ini_level
+    # carbon_price:  EUR/tCO2 on the community CO2 emissions in the objective
+
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    H, D, G, B = a['H'], a['D'], a['G'], a['B']
+    nT, nH, nB = len(a['T']), len(H), len(B)
+    dt = a['dt']
+    cycle = a.get('soc_cycle')
+    if cycle is not None and nT % cycle != 0:
+        raise ValueError('Periods are not a multiple of soc_cycle')
+
+    layout, n_vars = _variable_layout(nT, nH, nB)
+
+    t = np.arange(nT)
+    th_t = np.repeat(t, nH)
+    th_h = np.tile(np.arange(nH), nT)
+    tb_t = np.repeat(t, nB)
+    tb_b = np.tile(np.arange(nB), nT)
+
+    def col(v, i):
+        return layout[v] + i
+
+    def col2(v, ti, xi, n):
+        return layout[v] + ti*n + xi
+
+
+    ## CONSTRAINT ROWS
+    row_offset = {}
+    row_offset['energy_cost'] = 0
+    row_offset['grid_cost'] = nT
+    row_offset['energy_balance_grid'] = 2*nT
+    row_offset['energy_balance_house'] = 3*nT
+    row_offset['battery_soc'] = 3*nT + nT*nH
+    row_offset['carbon_emissions'] = 3*nT + nT*nH + nT*nB
+    n_rows = 4*nT + nT*nH + nT*nB
+
+    rows = []
+    cols = []
+    vals = []
+    b_eq = np.zeros(n_rows)
+
+    def add(r, c, v):
+        r = np.asarray(r)
+        rows.append(r)
+        cols.append(np.asarray(c))
+        vals.append(np.broadcast_to(np.asarray(v, dtype=float), r.shape))
+
+
+    mmr = a['marketmakerrate']
+    fit = a['feedintariff']
+    cf = a['community_fee']
+    gf = a['grid_fee']
+    ce = a['carbon_emission']
+
+    # Total energy cost per period
+    r = row_offset['energy_cost'] + t
+    add(r, col('COST_ENERGY', t), 1.0)
+    add(r, col('PL2_BUY', t), -mmr*dt)
+    add(r, col('PL2_SELL', t), fit*dt)
+
+    # Total grid cost per period
+    r = row_offset['grid_cost'] + t
+    add(r, col('COST_GRID', t), 1.0)
+    add(row_offset['grid_cost'] + th_t, col2('PL1_BUY', th_t, th_h, nH), -cf[th_t]*dt)
+    add(r, col('PL2_BUY', t), -gf*dt)
+    add(r, col('PL2_SELL', t), -(gf + cf)*dt)
+
+    # Community energy balance
+    r = row_offset['energy_balance_grid'] + t
+    add(r, col('PL2_SELL', t), 1.0)
+    add(r, col('PL2_BUY', t), -1.0)
+    add(row_offset['energy_balance_grid'] + th_t, col2('PL1_SELL', th_t, th_h, nH), -1.0)
+    add(row_offset['energy_balance_grid'] + th_t, col2('PL1_BUY', th_t, th_h, nH), 1.0)
+
+    # House energy balance
+    r = row_offset['energy_balance_house'] + th_t*nH + th_h
+    add(r, col2('PL1_SELL', th_t, th_h, nH), 1.0)
+    add(r, col2('PL1_BUY', th_t, th_h, nH), -1.0)
+
+    rhs = np.zeros((nT, nH))
+    g_pos = {g: i for i, g in enumerate(G)}
+    d_pos = {d: i for i, d in enumerate(D)}
+    b_pos = {b: i for i, b in enumerate(B)}
+
+    hg = np.array([[h, g_pos[m]] for h, m in enumerate(H) if m in g_pos], dtype=int).reshape(-1, 2)
+    hd = np.array([[h, d_pos[m]] for h, m in enumerate(H) if m in d_pos], dtype=int).reshape(-1, 2)
+    hb = np.array([[h, b_pos[m]] for h, m in enumerate(H) if m in b_pos], dtype=int).reshape(-1, 2)
+
+    rhs[:, hg[:, 0]] += a['generation'][:, hg[:, 1]]
+    rhs[:, hd[:, 0]] -= a['demand'][:, hd[:, 1]]
+    b_eq[row_offset['energy_balance_house']:row_offset['battery_soc']] = rhs.ravel()
+
+    if len(hb) > 0:
+        ht = np.repeat(t, len(hb))
+        hh = np.tile(hb[:, 0], nT)
+        bb = np.tile(hb[:, 1], nT)
+        r = row_offset['energy_balance_house'] + ht*nH + hh
+        add(r, col2('B_OUT', ht, bb, nB), -1.0)
+        add(r, col2('B_IN', ht, bb, nB), 1.0)
+
+    # Battery energy balance
+    if nB > 0:
+        r = row_offset['battery_soc'] + tb_t*nB + tb_b
+        eta_c = a['battery_efficiency_charge'][tb_b]
+        eta_d = a['battery_efficiency_discharge'][tb_b]
+        add(r, col2('BEL', tb_t, tb_b, nB), 1.0)
+        if cycle is None:
+            later = tb_t > 0
+            add(r[later], col2('BEL', tb_t[later] - 1, tb_b[later], nB), -1.0)
+            b_eq[row_offset['battery_soc'] + np.arange(nB)] = a['bel_ini_level']
+        else:
+            # The first period of a cycle follows its last period
+            previous = np.where(tb_t % cycle == 0, tb_t + cycle - 1, tb_t - 1)
+            add(r, col2('BEL', previous, tb_b, nB), -1.0)
+        add(r, col2('B_IN', tb_t, tb_b, nB), -eta_c*dt)
+        add(r, col2('B_OUT', tb_t, tb_b, nB), (1/eta_d)*dt)
+
+    # Community CO2 emissions
+    r = row_offset['carbon_emissions'] + t
+    add(r, col('CO2', t), 1.0)
+    add(r, col('PL2_BUY', t), -ce*dt)
+    add(r, col('PL2_SELL', t), ce*dt)
+
+    A_eq = sp.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n_rows, n_vars)).tocsr()
+
+
+    ## OBJECTIVE
+    # Minimize cost
+    c = np.zeros(n_vars)
+    weight = a.get('period_weight', 1.0)
+    c[layout['COST_ENERGY']:layout['COST_ENERGY'] + nT] = weight
+    c[layout['COST_GRID']:layout['COST_GRID'] + nT] = weight
+    c[layout['CO2']:layout['CO2'] + nT] = weight*a.get('carbon_price', 0.0)*CARBON_PRICE_SCALE
+
+
+    ## VARIABLE LIMITS
+    lb = np.zeros(n_vars)
+    ub = np.full(n_vars, np.inf)
+    for v in ['COST_ENERGY', 'COST_GRID', 'CO2']:
+        lb[layout[v]:layout[v] + nT] = -np.inf
+
+    if nB > 0:
+        lb[col2('BEL', tb_t, tb_b, nB)] = np.maximum(a['battery_min_level'][tb_b], 0.0)
+        ub[col2('BEL', tb_t, tb_b, nB)] = a['battery_capacity'][tb_b]
+        ub[col2('B_IN', tb_t, tb_b, nB)] = a['battery_charge_max'][tb_b]
+        ub[col2('B_OUT', tb_t, tb_b, nB)] = a['battery_discharge_max'][tb_b]
+
+
+    lp = dict()
+    lp['c'] = c
+    lp['A_eq'] = A_eq
+    lp['b_eq'] = b_eq
+    lp['lb'] = lb
+    lp['ub'] = ub
+    lp['layout'] = layout
+    lp['rows'] = row_offset
+    lp['T'] = a['T']
+    lp['H'] = H
+    lp['B'] = B
+
+    return lp
+
+
+
+def solve_matrix_model(lp, options=None):
+
+    # options: generic solver options as in d3a_solvers or scipy HiGHS options
+
+    if options is not None:
+        options = {MATRIX_OPTIONS.get(k, k): v for k, v in options.items() if k != 'threads'}
+
+    res = linprog(lp['c'], A_eq=lp['A_eq'], b_eq=lp['b_eq'], bounds=np.column_stack([lp['lb'], lp['ub']]),
+                  method='highs', options=options)
+
+    lp['status'] = res.status
+    lp['message'] = res.message
+
+    if res.status != 0:
+        print('Solver issue')
+        print('Status:', res.message)
+        lp['x'] = None
+        lp['objective'] = None
+    else:
+        lp['x'] = res.x
+        lp['objective'] = res.fun
+
+    return lp
+
+
+
+def matrix_variable(lp, name):
+
+    # Variable values of a solved matrix model as (T,) or (T, X) arrays
+
+    nT = len(lp['T'])
+    n = {'PL1_BUY': len(lp['H']), 'PL1_SELL': len(lp['H']),
+         'BEL': len(lp['B']), 'B_IN': len(lp['B']), 'B_OUT': len(lp['B'])}.get(name)
+
+    start = lp['layout'][name]
+    if n is None:
+        return lp['x'][start:start + nT]
+    else:
+        return lp['x'][start:start + nT*n].reshape(nT, n)
+
+
+
+def matrix_variables(lp):
+
+    return {v: matrix_variable(lp, v) for v in VARIABLES}
+
+
+
+def variables_solution(variables, members, batteries, mode='dict', periods=None):
+
+    # Same structure as d3a_opti.d3a_opti_solution() from (T,)/(T, X) variable arrays
+    #
+    # mode = 'dict'   nested dictionaries of lists as d3a_opti_solution()
+    #        'arrays' same keys with (T,) arrays, member and battery values as (T, H)/(T, B) arrays
+    #        'frames' tidy DataFrames 'community' (period), 'members' and 'batteries' (period, member)
+
+    if mode == 'arrays':
+        s = dict()
+        s['members'] = tuple(members)
+        s['batteries'] = tuple(batteries)
+        for k, v in SOLUTION_VARIABLES.items():
+            s[k] = variables[v]
+        return s
+
+    if mode == 'frames':
+        if periods is None:
+            periods = np.arange(1, len(variables['COST_ENERGY']) + 1)
+
+        s = dict()
+        s['community'] = pd.DataFrame({k: variables[SOLUTION_VARIABLES[k]] for k in SOLUTION_COMMUNITY},
+                                      index=pd.Index(periods, name='period'))
+
+        index = pd.MultiIndex.from_product([periods, list(members)], names=['period', 'member'])
+        s['members'] = pd.DataFrame({k: variables[SOLUTION_VARIABLES[k]].ravel() for k in SOLUTION_MEMBER}, index=index)
+
+        index = pd.MultiIndex.from_product([periods, list(batteries)], names=['period', 'member'])
+        s['batteries'] = pd.DataFrame({k: variables[SOLUTION_VARIABLES[k]].ravel() for k in SOLUTION_BATTERY}, index=index)
+        return s
+
+    if mode != 'dict':
+        raise ValueError('Unknown solution mode: %s' % mode)
+
+    s = dict()
+    s['members'] = tuple(members)
+
+    s['cost_energy'] = variables['COST_ENERGY'].tolist()
+    s['cost_grid'] = variables['COST_GRID'].tolist()
+
+    s['power_buy_community'] = variables['PL2_BUY'].tolist()
+    s['power_sell_community'] = variables['PL2_SELL'].tolist()
+
+    buy = variables['PL1_BUY']
+    sell = variables['PL1_SELL']
+    s['power_buy_member'] = {}
+    s['power_sell_member'] = {}
+    for i, m in enumerate(s['members']):
+        s['power_buy_member'][m] = buy[:, i].tolist()
+        s['power_sell_member'][m] = sell[:, i].tolist()
+
+
+    bel = variables['BEL']
+    b_in = variables['B_IN']
+    b_out = variables['B_OUT']
+    s['battery_soc_member'] = {}
+    s['battery_charge_member'] = {}
+    s['battery_discharge_member'] = {}
+    for i, b in enumerate(batteries):
+        s['battery_soc_member'][b] = bel[:, i].tolist()
+        s['battery_charge_member'][b] = b_in[:, i].tolist()
+        s['battery_discharge_member'][b] = b_out[:, i].tolist()
+
+    s['carbon_emissions'] = variables['CO2'].tolist()
+
+    return s
+
+
+
+def write_solution_parquet(s, path):
+
+    ## Example
+    # from d3a_opti import d3a_opti_solution
+    # from d3a_matrix import write_solution_parquet
+    #
+    # s = d3a_opti_solution(model_instance, mode='frames')
+    # write_solution_parquet(s, 'results/run_1')
+
+    # Writes community.parquet, members.parquet and batteries.parquet 
+    # from a 'frames' mode solution, requires pyarrow or fastparquet
+
+    os.makedirs(path, exist_ok=True)
+    for k in ['community', 'members', 'batteries']:
+        s[k].to_parquet(os.path.join(path, k + '.parquet'))
+
+
+
+def d3a_opti_matrix_solution(lp, mode='dict'):
+
+    # Same structure as d3a_opti.d3a_opti_solution()
+
+    return variables_solution(matrix_variables(lp), lp['H'], lp['B'], mode, lp['T'])
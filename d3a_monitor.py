@@ -0,0 +1,127 @@
+import sys
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+
+# Opt-in stage instrumentation for the optimization pipeline
+#
+# d3a_opti_input(), initialize_model(), solve_model() and d3a_opti_solution()
+# accept monitor=PipelineMonitor(). Every call records one stage with wall and
+# CPU time, current and peak RSS and stage specific fields (model size, solver
+# status, ...). Records are passed to the callbacks and logged to the 'd3a' logger.
+
+
+logger = logging.getLogger('d3a')
+
+
+
+def peak_rss_mb():
+
+    # Peak resident set size of this process, ru_maxrss is in kB on Linux and in bytes on macOS
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/1e6 if sys.platform == 'darwin' else rss*1024/1e6
+
+
+
+def rss_mb():
+
+    # Current resident set size, falls back to the peak where /proc is not available
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/1e6
+    except OSError:
+        return peak_rss_mb()
+
+
+
+class PipelineMonitor:
+
+    ## Example
+    # from d3a_monitor import PipelineMonitor
+    #
+    # monitor = PipelineMonitor(callbacks=[lambda r: metrics.send(r)], count_nonzeros=True)
+    # model_data = d3a_opti_input(data, monitor=monitor)
+    # model_instance = initialize_model(d3a_opti(), model_data, monitor=monitor)
+    # model_instance = solve_model(model_instance, solver='highs', monitor=monitor)
+    # s = d3a_opti_solution(model_instance, monitor=monitor)
+    # print(monitor.report())
+
+    def __init__(self, callbacks=None, log_level=logging.INFO, count_nonzeros=False):
+
+        self.records = []
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.log_level = log_level
+        self.count_nonzeros = count_nonzeros
+
+
+    @contextmanager
+    def stage(self, name, **info):
+
+        record = {'stage': name}
+        record.update(info)
+
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        rss0 = rss_mb()
+
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - t0
+            record['cpu_time'] = time.process_time() - c0
+            record['rss_mb'] = rss_mb()
+            record['rss_delta_mb'] = record['rss_mb'] - rss0
+            record['peak_rss_mb'] = peak_rss_mb()
+
+            self.records.append(record)
+
+            logger.log(self.log_level, '%s: %.3f s wall, %.3f s cpu, %.1f MB rss' % (name, record['wall_time'], record['cpu_time'], record['rss_mb']))
+
+            for callback in self.callbacks:
+                callback(record)
+
+
+    def summary(self):
+
+        # One row per recorded stage
+
+        return pd.DataFrame(self.records)
+
+
+    def report(self):
+
+        df = self.summary()
+        if len(df) == 0:
+            return 'No stages recorded'
+
+        lines = ['%-10s %10s %10s %10s %12s' % ('stage', 'wall [s]', 'cpu [s]', 'rss [MB]', 'peak [MB]')]
+        for r in self.records:
+            lines.append('%-10s %10.3f %10.3f %10.1f %12.1f' % (r['stage'], r['wall_time'], r['cpu_time'], r['rss_mb'], r['peak_rss_mb']))
+        lines.append('%-10s %10.3f %10.3f' % ('total', df['wall_time'].sum(), df['cpu_time'].sum()))
+
+        for r in self.records:
+            extra = {k: v for k, v in r.items() if k not in ['stage', 'wall_time', 'cpu_time', 'rss_mb', 'rss_delta_mb', 'peak_rss_mb']}
+            if len(extra) > 0:
+                lines.append('%s: %s' % (r['stage'], ', '.join('%s=%s' % (k, v) for k, v in extra.items())))
+
+        return '\n'.join(lines)
+
+
+
+@contextmanager
+def monitor_stage(monitor, name, **info):
+
+    # Stage of the monitor or a plain record dictionary when monitor is None
+
+    if monitor is None:
+        yield dict(info)
+    else:
+        with monitor.stage(name, **info) as record:
+            yield record
@@ -1,26 +1,165 @@
 from pyomo.environ import AbstractModel,Set,Param,Var,Objective,Constraint,SolverFactory
 from pyomo.environ import NonNegativeReals, inequality
 from pyomo.environ import value
+from pyomo.core.expr.visitor import identify_variables
+import time
+import numpy as np
+import pandas as pd
 
+from d3a_matrix import VARIABLES, CARBON_PRICE_SCALE, variables_solution
+from d3a_solvers import get_solver, SOLVER_BACKENDS
+from d3a_monitor import monitor_stage
 
 
-def initialize_model(model, model_data):
 
-    model_instance = model.create_instance(model_data)
+def initialize_model(model, model_data, monitor=None):
+
+    with monitor_stage(monitor, 'build') as record:
+        model_instance = model.create_instance(model_data)
+
+        if monitor is not None:
+            record['variables'] = model_instance.nvariables()
+            record['constraints'] = model_instance.nconstraints()
+            if monitor.count_nonzeros:
+                record['nonzeros'] = sum(len(list(identify_variables(c.body))) for c in model_instance.component_data_objects(Constraint, active=True))
+
+    return model_instance
+
+
+def solve_model(model_instance, optimizer=None, solver=None, options=None, tee=False, keepfiles=False, monitor=None):        
+
+    # solver = 'glpk'/'cbc'/'highs'/'gurobi'/'cplex'/'xpress' or any SolverFactory name, see d3a_solvers
+    # options = {'threads': 4, 'time_limit': 60, 'feasibility_tolerance': 1e-7, 'optimality_tolerance': 1e-7}
+    # Without optimizer and solver glpk is run with solver output and kept files as before
+
+    with monitor_stage(monitor, 'solve', solver=solver) as record:
+        t0 = time.perf_counter()
+        if optimizer is None and solver is None:
+            optimizer = SolverFactory("glpk", executable="/usr/bin/glpsol")
+            results = optimizer.solve(model_instance, tee=True, keepfiles=True)
+        elif optimizer is None:
+            optimizer = get_solver(solver, options)
+            results = optimizer.solve(model_instance, tee=tee, keepfiles=keepfiles)
+        else:
+            results = optimizer.solve(model_instance)
+        solve_time = time.perf_counter() - t0
+
+        if monitor is not None:
+            name = getattr(optimizer, 'name', None)
+            record['solver'] = name if name is not None else solver
+            record['status'] = str(results.solver.status)
+            record['termination_condition'] = str(results.solver.termination_condition)
+            # Time reported by the solver itself, the rest of the stage is model writing and loading
+            # In-memory solvers (appsi) report none, their time is the wall time of the solve call
+            solver_time = getattr(results.solver, 'time', None)
+            if not isinstance(solver_time, (int, float)):
+                solver_time = getattr(results.solver, 'wallclock_time', None)
+            record['solver_time'] = solver_time if isinstance(solver_time, (int, float)) else solve_time
+
 
     return model_instance
 
 
-def solve_model(model_instance):        
-    optimizer = SolverFactory("glpk", executable="/usr/bin/glpsol")
-    optimizer.solve(model_instance, tee=True, keepfiles=True)
 
+def persistent_solver(solver='highs', options=None):
+
+    ## Example
+    # from d3a_opti import d3a_opti, initialize_model, solve_model, persistent_solver, update_model
+    #
+    # model_instance = initialize_model(d3a_opti(mutable=True), model_data)
+    # optimizer = persistent_solver()
+    # model_instance = solve_model(model_instance, optimizer)
+    #
+    # update_model(model_instance, marketmakerrate=new_prices)
+    # model_instance = solve_model(model_instance, optimizer)
+
+    # In-process persistent solver that keeps the model between solves
+    # Only mutable Param values are re-read on the following solves, 
+    # the constraint structure is expected to stay unchanged
+    # Needs an appsi solver ('highs' or an 'appsi_...' SolverFactory name)
+
+    if not SOLVER_BACKENDS.get(solver, {'name': solver})['name'].startswith('appsi_'):
+        raise ValueError('Solver %s is not an appsi persistent solver, use solver=\'highs\'' % solver)
+
+    optimizer = get_solver(solver, options)
+
+    optimizer.update_config.check_for_new_or_removed_constraints = False
+    optimizer.update_config.check_for_new_or_removed_vars = False
+    optimizer.update_config.check_for_new_or_removed_params = False
+    optimizer.update_config.check_for_new_objective = False
+    optimizer.update_config.update_constraints = False
+    optimizer.update_config.update_vars = False
+    optimizer.update_config.update_named_expressions = False
+    optimizer.update_config.update_objective = False
+    optimizer.update_config.update_params = True
+
+    return optimizer
+
+
+
+def update_model(model_instance, members=None, **params):
+
+    # Push new values into the mutable Params of a d3a_opti(mutable=True) instance
+    # Values are dictionaries keyed as in d3a_opti_input(), DataFrames with one column
+    # per member for demand/generation, Series indexed by member for bel_ini_level,
+    # or arrays: (T,) for the tariffs, (T, D)/(T, G) for demand/generation, (B,) for
+    # bel_ini_level and a scalar for carbon_price
+    # The members of arrays are in the order of members, or of the model sets
+    # (model_instance.D/G/B, the order of the input data) when members is None
+    #
+    # update_model(model_instance, marketmakerrate=mmr, demand=demand_frame)
+    # update_model(model_instance, members=names, demand=demand_array)
+
+    for name, values in params.items():
+        param = getattr(model_instance, name)
+
+        if not param.mutable:
+            raise ValueError('Parameter %s is not mutable, build the model with d3a_opti(mutable=True)' % name)
+
+        if not isinstance(values, dict):
+            index = list(param.index_set())
+            values = _set_order(param, values, members).ravel()
+            if len(values) != len(index):
+                raise ValueError('Parameter %s has %d values, %d given' % (name, len(index), len(values)))
+            values = dict(zip(index, values))
+
+        param.store_values(values)
 
     return model_instance
 
 
 
-def d3a_opti():
+def _set_order(param, values, members):
+
+    # Array of the values with the members in the order of the member set of param
+
+    sets = list(param.index_set().subsets()) if param.is_indexed() else []
+    member_set = [s for s in sets if s.local_name in ['D', 'G', 'B']]
+    if len(member_set) == 0:
+        return np.asarray(values, dtype=float)
+    order = list(member_set[0])
+
+    if isinstance(values, (pd.DataFrame, pd.Series)):
+        labels = values.columns if isinstance(values, pd.DataFrame) else values.index
+    elif members is not None:
+        labels = list(members)
+        values = np.asarray(values, dtype=float)
+        values = pd.DataFrame(values, columns=labels) if values.ndim == 2 else pd.Series(values, index=labels)
+    else:
+        return np.asarray(values, dtype=float)
+
+    missing = [m for m in order if m not in labels]
+    if len(missing) > 0:
+        raise ValueError('No %s values of members %s' % (param.local_name, missing))
+
+    return values[order].to_numpy(dtype=float)
+
+
+
+def d3a_opti(mutable=False):
+
+    # mutable=True declares demand, generation, tariffs, fees, emission factors,
+    # carbon_price and bel_ini_level as mutable Params so that they can be changed with update_model()
 
     model = AbstractModel()
 
@@ -33,20 +172,21 @@ def d3a_opti():
 
 
     ## PARAMETERS
-    model.demand                        = Param(model.T, model.D)
-    model.generation                    = Param(model.T, model.G)
+    model.demand                        = Param(model.T, model.D, mutable=mutable)
+    model.generation                    = Param(model.T, model.G, mutable=mutable)
     model.battery_min_level             = Param(model.B, within=NonNegativeReals, default=0.0)
     model.battery_capacity              = Param(model.B, within=NonNegativeReals, default=0.0)
     model.battery_charge_max            = Param(model.B, within=NonNegativeReals, default=0.0)
     model.battery_discharge_max         = Param(model.B, within=NonNegativeReals, default=0.0)
     model.battery_efficiency_charge     = Param(model.B, within=NonNegativeReals, default=1.0)
     model.battery_efficiency_discharge  = Param(model.B, within=NonNegativeReals, default=1.0)
-    model.bel_ini_level                 = Param(model.B, within=NonNegativeReals, default=0.0)
-    model.marketmakerrate               = Param(model.T)
-    model.feedintariff                  = Param(model.T)
-    model.community_fee                 = Param(model.T)
-    model.grid_fee                      = Param(model.T)
-    model.carbon_emission               = Param(model.T)
+    model.bel_ini_level                 = Param(model.B, within=NonNegativeReals, default=0.0, mutable=mutable)
+    model.marketmakerrate               = Param(model.T, mutable=mutable)
+    model.feedintariff                  = Param(model.T, mutable=mutable)
+    model.community_fee                 = Param(model.T, mutable=mutable)
+    model.grid_fee                      = Param(model.T, mutable=mutable)
+    model.carbon_emission               = Param(model.T, mutable=mutable)
+    model.carbon_price                  = Param(default=0.0, mutable=mutable)
     model.dt                            = Param()
 
     
@@ -65,9 +205,9 @@ def d3a_opti():
 
 
     ## OBJECTIVE
-    # Minimize cost
+    # Minimize cost, CO2 emissions at carbon_price (EUR/tCO2)
     def total_cost(model):
-        return sum(model.COST_ENERGY[t] + model.COST_GRID[t] for t in model.T)
+        return sum(model.COST_ENERGY[t] + model.COST_GRID[t] + model.carbon_price*CARBON_PRICE_SCALE*model.CO2[t] for t in model.T)
     model.total_cost = Objective(rule=total_cost)
 
 
@@ -131,7 +271,37 @@ def d3a_opti():
 
 
 
-def d3a_opti_solution(solution):
+def model_variables(solution):
+
+    # All variable values in one pass per variable as (T,) or (T, X) arrays in set order
+
+    nT = len(solution.T)
+
+    variables = dict()
+    for v in VARIABLES:
+        var = solution.component(v)
+        x = np.array([x.value for x in var.values()], dtype=float)
+        variables[v] = x if var.dim() == 1 else x.reshape(nT, x.size//max(nT, 1))
+
+    return variables
+
+
+
+def d3a_opti_solution(solution, mode='dict', monitor=None):
+
+    # mode = 'dict'/'arrays'/'frames', see d3a_matrix.variables_solution()
+
+    with monitor_stage(monitor, 'extract', mode=mode):
+        if mode != 'dict':
+            s = variables_solution(model_variables(solution), solution.H.data(), solution.B.data(), mode, list(solution.T.data()))
+        else:
+            s = _solution_dict(solution)
+
+    return s
+
+
+
+def _solution_dict(solution):
     
     s = dict()
     s['members'] = solution.H.data()
@@ -0,0 +1,322 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import nordpool
+import fingridopendata
+import nuukaopenapi
+import energydatamap
+from d3a_input import d3a_opti_input_frames, TARIFF_FIELDS, BATTERY_FIELDS
+from d3a_monitor import monitor_stage
+
+
+
+# Ingestion pipeline from the data source modules to the optimizer input
+#
+# prices:      nordpool.get_elspot_prices() of the region (EUR/MWh)
+# emissions:   fingridopendata.get_open_data() of emission_variable (gCO2/kWh)
+# demand:      nuukaopenapi.get_property_data_bulk() of the member properties (hourly kWh)
+# generation:  energydatamap.get_pv_generation_batch() of the member PV systems (kW)
+#
+# The sources are fetched concurrently and aligned on a regular UTC grid of dt hours,
+# finer data is averaged and coarser data is held over its resolution. Prices and
+# tariffs are in EUR/kWh, demand and generation in kW (average over the period).
+#
+# With cache_dir every source uses its own cache in a subdirectory of cache_dir,
+# Nuuka data is cached here for periods that ended more than CACHE_MIN_AGE ago.
+#
+# Missing periods of a source are filled from the neighbouring values up to
+# max_missing (fraction of the periods), the filled periods of every source are
+# in record['filled'] of the 'align' stage. Members without demand data and
+# sources missing more periods raise ValueError.
+
+
+# market maker rate = spot + retail margin, feed in tariff = spot - feed in margin (EUR/kWh)
+# carbon emission factor is used when no Fingrid API key is given
+PIPELINE_TARIFFS = {'retail margin': 0.0,
+                    'feed in margin': 0.0,
+                    'community fee': 0.0,
+                    'grid fee': 0.0,
+                    'carbon emission factor': None}
+
+CACHE_MIN_AGE = pd.Timedelta(days=2)
+
+MAX_MISSING = 0.05
+
+
+
+def d3a_pipeline(members, start_time, end_time, dt = 1.0, region = 'FI', currency = 'EUR', fingrid_api_key = None, emission_variable = 265,
+                 tariffs = None, output = 'data', tz = 'Europe/Helsinki', cache_dir = None, max_workers = 8, max_missing = MAX_MISSING,
+                 pv_column = None, monitor = None):
+
+    ## Example
+    # from d3a_pipeline import d3a_pipeline
+    # from d3a_input import d3a_opti_input
+    #
+    # members = {'hall': {'property': '1000 Hakaniemen kauppahalli',
+    #                     'pv': {'latitude': 60.18, 'longitude': 24.95, 'capacity_kw': 50, 'azimuth': 180, 'tilt': 30},
+    #                     'battery': {'min soc': 5, 'capacity': 50, 'charging power': 15, 'discharging power': 15,
+    #                                 'charging efficiency': 0.95, 'discharging efficiency': 0.95}},
+    #            ...}
+    # tariffs = {'retail margin': 0.005, 'feed in margin': 0.002, 'community fee': 0.01, 'grid fee': 0.03}
+    #
+    # data = d3a_pipeline(members, '2021-01-01 00:00', '2021-02-01 00:00', dt = 0.25, fingrid_api_key = api_key,
+    #                     tariffs = tariffs, cache_dir = 'd3a_cache')
+    # model_data = d3a_opti_input(data)
+    #
+    # start_time, end_time: local time in tz, the last period starts before end_time
+    # output = 'data'   input data dictionary of d3a_opti_input()
+    #          'arrays' array input of d3a_opti_input_frames()
+    #          'frames' (demand, generation, tariffs, batteries) DataFrames of d3a_opti_input_frames()
+    # members: 'property' (Nuuka search string, optional), 'reporting_group' (default 'Electricity'),
+    #          'search_record' (default 'LocationName'), 'pv' (energydatamap parameters without dates, optional),
+    #          'battery' (battery fields of the input data, optional)
+    # pv_column: field of the energydatamap response with the generation, needed when it has several numeric fields
+
+
+    t = dict(PIPELINE_TARIFFS)
+    if tariffs is not None:
+        t.update(tariffs)
+
+    if fingrid_api_key is None and t['carbon emission factor'] is None:
+        raise ValueError('Give fingrid_api_key or a carbon emission factor in tariffs')
+
+    t1 = pd.Timestamp(start_time).tz_localize(tz)
+    t2 = pd.Timestamp(end_time).tz_localize(tz)
+    step = pd.Timedelta(hours=dt)
+    grid = pd.date_range(t1.tz_convert('UTC'), t2.tz_convert('UTC'), freq=step, inclusive='left')
+
+    names = list(members.keys())
+
+
+    ## FETCH
+    with monitor_stage(monitor, 'fetch', members=len(names)) as record:
+        sources = {}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {'prices': executor.submit(_get_prices, grid, step, region, currency, cache_dir),
+                       'demand': executor.submit(_get_demand, members, t1, t2, cache_dir, max_workers)}
+            if fingrid_api_key is not None:
+                futures['emissions'] = executor.submit(_get_emissions, fingrid_api_key, emission_variable, grid, step, cache_dir, max_workers)
+            if any('pv' in m for m in members.values()):
+                futures['generation'] = executor.submit(_get_generation, members, t1, t2, dt, cache_dir, max_workers, pv_column)
+            for source, f in futures.items():
+                sources[source] = f.result()
+                if sources[source] is None:
+                    raise RuntimeError('No %s data for the period' % source)
+
+
+    ## ALIGN
+    with monitor_stage(monitor, 'align', periods=len(grid)) as record:
+        filled = record['filled'] = {}
+        spot = _align(sources['prices'], grid, 'prices', max_missing, filled)/1000
+
+        tariff_frame = pd.DataFrame(index=grid)
+        tariff_frame[TARIFF_FIELDS['marketmakerrate']] = spot + t['retail margin']
+        tariff_frame[TARIFF_FIELDS['feedintariff']] = spot - t['feed in margin']
+        tariff_frame[TARIFF_FIELDS['community_fee']] = t['community fee']
+        tariff_frame[TARIFF_FIELDS['grid_fee']] = t['grid fee']
+        if 'emissions' in sources:
+            tariff_frame[TARIFF_FIELDS['carbon_emission']] = _align(sources['emissions'], grid, 'emissions', max_missing, filled)
+        else:
+            tariff_frame[TARIFF_FIELDS['carbon_emission']] = t['carbon emission factor']
+
+        # Hourly energy to average power
+        demand = pd.DataFrame(0.0, index=grid, columns=names)
+        panel = sources['demand']
+        columns = _demand_columns(members)
+        missing = [nm for nm, column in columns.items() if column not in panel.columns]
+        if len(missing) > 0:
+            raise ValueError('No demand data for members %s, properties %s' % (missing, [columns[nm] for nm in missing]))
+
+        hours = _resolution(panel.index)/pd.Timedelta(hours=1)
+        for nm, column in columns.items():
+            demand[nm] = _align(panel[column]/hours, grid, 'demand of %s' % nm, max_missing, filled)
+
+        generation = pd.DataFrame(0.0, index=grid, columns=names)
+        for nm, s in sources.get('generation', {}).items():
+            generation[nm] = _align(s, grid, 'generation of %s' % nm, max_missing, filled)
+
+        batteries = pd.DataFrame([members[nm].get('battery', {}) for nm in names], index=names, columns=list(BATTERY_FIELDS.values()))
+
+    if output == 'frames':
+        return demand, generation, tariff_frame, batteries
+
+    if output == 'arrays':
+        return d3a_opti_input_frames(demand, generation, tariff_frame, batteries)
+
+    if output == 'data':
+        return _frames_data(demand, generation, tariff_frame, batteries, tz)
+
+    raise ValueError('Unknown output option: %s' % output)
+
+
+
+def _get_prices(grid, step, region, currency, cache_dir):
+
+    # Spot prices of the region over the grid, one hour before the first period
+    # for the prices held over the first period
+
+    df = nordpool.get_elspot_prices((grid[0] - pd.Timedelta(hours=1)).tz_localize(None), (grid[-1] + step).tz_localize(None),
+                                    regions=[region], currency=currency, cache_dir=_subdir(cache_dir, 'nordpool'))
+
+    return df[region]
+
+
+
+def _get_emissions(api_key, variable_id, grid, step, cache_dir, max_workers):
+
+    t1 = (grid[0] - pd.Timedelta(hours=1)).tz_localize(None)
+    t2 = (grid[-1] + step).tz_localize(None)
+    df = fingridopendata.get_open_data(api_key, variable_id, t1, t2, max_workers=max_workers, store_dir=_subdir(cache_dir, 'fingrid'))
+    if df is None:
+        return
+
+    return df['value'].droplevel('end_time')
+
+
+
+def _demand_columns(members):
+
+    return {nm: (m['property'], m.get('reporting_group', 'Electricity')) for nm, m in members.items() if 'property' in m}
+
+
+
+def _get_demand(members, t1, t2, cache_dir, max_workers):
+
+    # Panel of the member properties with one (search_string, reporting_group) column each, in UTC
+
+    columns = _demand_columns(members)
+    if len(columns) == 0:
+        return pd.DataFrame()
+
+    pairs = list(dict.fromkeys(columns.values()))
+    records = {m.get('search_record', 'LocationName') for m in members.values() if 'property' in m}
+    if len(records) > 1:
+        raise ValueError('Members have different search records')
+    search_record = records.pop()
+
+    # Nuuka times are local time in Helsinki
+    start = t1.tz_convert('Europe/Helsinki').strftime('%Y-%m-%d %H:%M')
+    end = t2.tz_convert('Europe/Helsinki').strftime('%Y-%m-%d %H:%M')
+
+    path = None
+    directory = _subdir(cache_dir, 'nuuka')
+    if directory is not None and t2 < pd.Timestamp.now(tz='UTC') - CACHE_MIN_AGE:
+        key = json.dumps([pairs, start, end, search_record])
+        path = os.path.join(directory, 'demand_%s.parquet' % hashlib.sha1(key.encode()).hexdigest()[:16])
+        if os.path.exists(path):
+            df = pd.read_parquet(path)
+            df.columns = pd.MultiIndex.from_tuples(df.columns)
+            return df
+
+    df = nuukaopenapi.get_property_data_bulk(pairs, start, end, search_record=search_record, max_workers=max_workers, panel=True)
+    if df is None:
+        return
+
+    df.index = df.index.tz_convert('UTC')
+    df = df.sort_index()
+
+    if path is not None:
+        os.makedirs(directory, exist_ok=True)
+        df.to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    return df
+
+
+
+def _get_generation(members, t1, t2, dt, cache_dir, max_workers, pv_column=None):
+
+    # PV generation of the members with a PV system, in UTC
+    # pv_column is the generation field, the only numeric field of the response when None
+
+    names = [nm for nm, m in members.items() if 'pv' in m]
+
+    dates = {'start_date': t1.tz_convert('UTC').strftime('%Y-%m-%d'),
+             'end_date': t2.tz_convert('UTC').strftime('%Y-%m-%d'),
+             'frequency': '%dmin' % max(int(round(dt*60)), 1)}
+    columns = None if pv_column is None else [pv_column]
+    dfs = energydatamap.get_pv_generation_batch([dict(members[nm]['pv'], **dates) for nm in names],
+                                                cache_dir=_subdir(cache_dir, 'pv'), max_workers=max_workers, columns=columns)
+
+    generation = {}
+    for nm, df in zip(names, dfs):
+        if df is None:
+            return
+        fields = energydatamap.generation_columns(df, columns)
+        if len(fields) != 1:
+            raise ValueError('PV data of %s has the numeric fields %s, select the generation with pv_column' % (nm, fields))
+        s = df[fields[0]]
+        if s.index.tz is None:
+            s.index = s.index.tz_localize('UTC')
+        generation[nm] = s
+
+    return generation
+
+
+
+def _resolution(index):
+
+    return pd.Series(index).diff().median() if len(index) > 1 else pd.Timedelta(hours=1)
+
+
+
+def _align(s, grid, name, max_missing=MAX_MISSING, filled=None):
+
+    # Values of s on the grid, finer data is averaged over the periods,
+    # coarser data holds over its resolution
+    # Up to max_missing of the periods are filled, filled[name] is their number
+
+    s = s[~s.index.duplicated()].sort_index()
+    s.index = s.index.tz_convert('UTC')
+
+    resolution = _resolution(s.index)
+    step = grid[1] - grid[0] if len(grid) > 1 else resolution
+
+    if resolution >= step:
+        values = s.reindex(grid, method='ffill', tolerance=resolution - pd.Timedelta(1, 'ns'))
+    else:
+        values = s.resample(step, origin=grid[0]).mean().reindex(grid)
+
+    missing = int(values.isna().sum())
+    if missing > max_missing*len(grid):
+        first = values.index[values.isna()][0]
+        raise ValueError('%s is missing %d of %d periods (max_missing %g), first %s' % (name, missing, len(grid), max_missing, first))
+
+    if missing > 0:
+        values = values.ffill().bfill()
+        if filled is not None:
+            filled[name] = missing
+
+    return values.to_numpy(dtype=float)
+
+
+
+def _frames_data(demand, generation, tariffs, batteries, tz):
+
+    # Input data dictionary of d3a_opti_input() with local timestamps
+
+    timestamps = demand.index.tz_convert(tz)
+
+    batteries = batteries.reindex(demand.columns)
+    for field in BATTERY_FIELDS.values():
+        batteries[field] = batteries[field].fillna(1.0 if 'efficiency' in field else 0.0)
+
+    data = dict()
+    for nm in demand.columns:
+        data[nm] = {'timestamps': timestamps}
+        for field in TARIFF_FIELDS.values():
+            data[nm][field] = tariffs[field].to_numpy(dtype=float)
+        data[nm]['demand'] = demand[nm].to_numpy(dtype=float)
+        data[nm]['generation'] = generation[nm].to_numpy(dtype=float)
+        data[nm]['battery'] = {field: float(batteries.loc[nm, field]) for field in BATTERY_FIELDS.values()}
+
+    return data
+
+
+
+def _subdir(cache_dir, name):
+
+    return None if cache_dir is None else os.path.join(cache_dir, name)
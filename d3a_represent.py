@@ -0,0 +1,155 @@
+import time
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+from d3a_matrix import d3a_opti_matrix, solve_matrix_model, matrix_variables, variables_solution
+from d3a_matrix import model_data_arrays, PERIOD_PARAMS
+
+
+
+# Representative days for long horizons (sizing studies)
+#
+# The days of the horizon are clustered with k-means on the community demand,
+# generation and tariff profiles. Each cluster is represented by its medoid, an
+# actual day of the data with all member profiles, weighted by the number of days
+# in the cluster. The `extremes` days with the highest net demand peak can be kept
+# as their own representative days. The reduced LP is solved with the matrix
+# engine with the period costs weighted and the battery level cyclic over every
+# representative day (soc_cycle), so no day can borrow energy from another.
+
+
+
+def representative_days(model_data, k = 12, extremes = 0, seed = 0):
+
+    ## Example
+    # from d3a_represent import representative_days
+    # from d3a_matrix import d3a_opti_matrix, solve_matrix_model
+    #
+    # r, info = representative_days(a, k = 12, extremes = 2)
+    # lp = solve_matrix_model(d3a_opti_matrix(r))
+
+    # r: array input of the representative days with period_weight and soc_cycle
+    # info: 'days' (0-based day index), 'weights', 'labels' (representative day of every day)
+
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    nT = len(a['T'])
+    P = int(round(24/a['dt']))
+    if nT % P != 0:
+        raise ValueError('The horizon is not whole days of %d periods' % P)
+    n_days = nT//P
+
+    demand = a['demand'].sum(axis=1).reshape(n_days, P)
+    generation = a['generation'].sum(axis=1).reshape(n_days, P)
+
+    if k + extremes >= n_days:
+        days = np.arange(n_days)
+        weights = np.ones(n_days)
+        labels = np.arange(n_days)
+
+    else:
+        # Standardized daily profiles
+        series = [demand, generation] + [np.asarray(a[p], dtype=float).reshape(n_days, P) for p in PERIOD_PARAMS]
+        features = np.hstack([(x - x.mean())/(x.std() if x.std() > 0 else 1.0) for x in series])
+
+        peak = (demand - generation).max(axis=1)
+        extreme_days = np.argsort(-peak, kind='stable')[:extremes]
+        rest = np.setdiff1d(np.arange(n_days), extreme_days)
+
+        centroids, cluster = kmeans2(features[rest], k, minit='++', seed=np.random.default_rng(seed))
+
+        days = list(extreme_days)
+        weights = [1.0]*len(extreme_days)
+        labels = np.empty(n_days, dtype=int)
+        labels[extreme_days] = np.arange(len(extreme_days))
+        for j in range(k):
+            members = rest[cluster == j]
+            if len(members) == 0:
+                continue
+            distance = ((features[members] - centroids[j])**2).sum(axis=1)
+            labels[members] = len(days)
+            days.append(members[np.argmin(distance)])
+            weights.append(float(len(members)))
+
+        # Representative days in time order
+        order = np.argsort(days)
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+        days = np.asarray(days)[order]
+        weights = np.asarray(weights)[order]
+        labels = rank[labels]
+
+    index = (days[:, None]*P + np.arange(P)).ravel()
+
+    r = dict(a)
+    r['T'] = np.arange(1, len(index) + 1)
+    r['demand'] = a['demand'][index]
+    r['generation'] = a['generation'][index]
+    for p in PERIOD_PARAMS:
+        r[p] = np.asarray(a[p])[index]
+    r['period_weight'] = np.repeat(weights, P)
+    r['soc_cycle'] = P
+
+    info = {'days': days, 'weights': weights, 'labels': labels, 'periods_per_day': P}
+
+    return r, info
+
+
+
+def d3a_opti_representative(model_data, k = 12, extremes = 0, seed = 0, compare = False, options = None, mode = 'dict'):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_arrays
+    # from d3a_represent import d3a_opti_representative
+    #
+    # a = d3a_opti_input_arrays(data)
+    # s, stats = d3a_opti_representative(a, k = 12, extremes = 2, compare = True)
+    #
+    # s has the structure of d3a_opti_solution() over the periods of the representative days
+    # stats['cost'], stats['co2'] are the estimates for the horizon, 'annual_cost', 'annual_co2' per 365 days
+    # stats['cost_error'], stats['co2_error'] are relative to the full horizon solve when compare=True
+
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    t0 = time.perf_counter()
+    r, info = representative_days(a, k, extremes, seed)
+
+    lp = solve_matrix_model(d3a_opti_matrix(r), options)
+    if lp['x'] is None:
+        raise RuntimeError('Representative day solve failed: %s' % lp['message'])
+    variables = matrix_variables(lp)
+
+    n_days = len(a['T'])//info['periods_per_day']
+
+    stats = dict()
+    stats['days'] = n_days
+    stats['representative_days'] = info['days']
+    stats['weights'] = info['weights']
+    stats['periods'] = len(r['T'])
+    stats['cost'] = lp['objective']
+    stats['co2'] = float(np.sum(r['period_weight']*variables['CO2']))
+    stats['annual_cost'] = stats['cost']*365/n_days
+    stats['annual_co2'] = stats['co2']*365/n_days
+    stats['time'] = time.perf_counter() - t0
+
+    if compare:
+        t0 = time.perf_counter()
+        full = solve_matrix_model(d3a_opti_matrix(a), options)
+        stats['full_time'] = time.perf_counter() - t0
+        stats['full_cost'] = full['objective']
+        if full['x'] is not None:
+            stats['full_co2'] = float(np.sum(matrix_variables(full)['CO2']))
+            stats['cost_error'] = (stats['cost'] - stats['full_cost'])/max(abs(stats['full_cost']), 1e-9)
+            stats['co2_error'] = (stats['co2'] - stats['full_co2'])/max(abs(stats['full_co2']), 1e-9)
+
+    s = variables_solution(variables, r['H'], r['B'], mode)
+
+    return s, stats
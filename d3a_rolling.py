@@ -0,0 +1,148 @@
+import time
+import numpy as np
+
+from d3a_opti import d3a_opti, initialize_model, solve_model, persistent_solver, update_model, d3a_opti_solution
+from d3a_matrix import model_data_arrays, arrays_model_data, slice_arrays, PERIOD_PARAMS, CARBON_PRICE_SCALE
+
+
+
+# Rolling horizon (receding horizon / MPC) runner
+#
+# The time series is walked in windows of window_hours of which the first
+# commit_hours are committed. The final battery level of the committed part is
+# carried over as bel_ini_level of the next window. One mutable model instance
+# and persistent solver per window length is built and reused for all windows.
+
+
+SOLUTION_SERIES = ['cost_energy', 'cost_grid', 'power_buy_community', 'power_sell_community', 'carbon_emissions']
+SOLUTION_MEMBER_SERIES = ['power_buy_member', 'power_sell_member', 'battery_soc_member', 'battery_charge_member', 'battery_discharge_member']
+
+
+
+def _window_model(w, solver, options):
+
+    model_instance = initialize_model(d3a_opti(mutable=True), arrays_model_data(w))
+    optimizer = persistent_solver(solver, options)
+
+    return model_instance, optimizer
+
+
+
+def _commit_solution(s, n, committed):
+
+    # Append the first n periods of window solution s to the committed solution
+
+    if committed is None:
+        committed = {'members': s['members']}
+        for k in SOLUTION_SERIES:
+            committed[k] = []
+        for k in SOLUTION_MEMBER_SERIES:
+            committed[k] = {m: [] for m in s[k]}
+
+    for k in SOLUTION_SERIES:
+        committed[k].extend(s[k][:n])
+    for k in SOLUTION_MEMBER_SERIES:
+        for m in s[k]:
+            committed[k][m].extend(s[k][m][:n])
+
+    return committed
+
+
+
+def d3a_opti_rolling(model_data, window_hours=48, commit_hours=24, solver='highs', options=None, verbose=False):
+
+    ## Example
+    # from d3a_input import d3a_opti_input
+    # from d3a_rolling import d3a_opti_rolling
+    #
+    # model_data = d3a_opti_input(data)
+    # s, stats = d3a_opti_rolling(model_data, window_hours=48, commit_hours=24)
+    #
+    # s has the structure of d3a_opti_solution() over the full horizon
+    # stats['windows'] has the per-window timing, stats['periods_per_second'] the throughput
+    # verbose=True also prints the timing of every window
+
+
+    t_start = time.perf_counter()
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    nT = len(a['T'])
+    window = int(round(window_hours/a['dt']))
+    commit = int(round(commit_hours/a['dt']))
+
+    if commit < 1 or window < commit:
+        raise ValueError('Window must be at least one period and not shorter than the committed part')
+
+    models = dict()
+    bel = np.asarray(a['bel_ini_level'], dtype=float)
+
+    # Window costs are objective values, with the emissions at carbon_price
+    carbon_price = a.get('carbon_price', 0.0)*CARBON_PRICE_SCALE
+
+    committed = None
+    windows = []
+
+    start = 0
+    while start < nT:
+
+        stop = min(start + window, nT)
+        n = stop - start if stop == nT else commit
+
+        t0 = time.perf_counter()
+        w = slice_arrays(a, start, stop)
+        w['bel_ini_level'] = bel
+
+        # Build once per window length, afterwards only push the new data
+        if stop - start not in models:
+            models[stop - start] = _window_model(w, solver, options)
+            model_instance, optimizer = models[stop - start]
+        else:
+            model_instance, optimizer = models[stop - start]
+            update = {p: w[p] for p in PERIOD_PARAMS}
+            update['demand'] = w['demand']
+            update['generation'] = w['generation']
+            update['bel_ini_level'] = bel
+            update_model(model_instance, **update)
+
+        t1 = time.perf_counter()
+        solve_model(model_instance, optimizer)
+
+        t2 = time.perf_counter()
+        s = d3a_opti_solution(model_instance)
+        committed = _commit_solution(s, n, committed)
+
+        # Battery level at the end of the committed periods
+        bel = np.maximum([s['battery_soc_member'][b][n-1] for b in a['B']], 0.0)
+        t3 = time.perf_counter()
+
+        windows.append({'start': start,
+                        'periods': stop - start,
+                        'committed': n,
+                        'build_time': t1 - t0,
+                        'solve_time': t2 - t1,
+                        'extract_time': t3 - t2,
+                        'time': t3 - t0,
+                        'cost': float(np.sum(s['cost_energy'][:n]) + np.sum(s['cost_grid'][:n]) + carbon_price*np.sum(s['carbon_emissions'][:n]))})
+
+        if verbose:
+            print('Window %d: periods %d-%d, %.2f s' % (len(windows), start + 1, start + n, t3 - t0))
+
+        if stop == nT:
+            break
+        start += commit
+
+
+    total_time = time.perf_counter() - t_start
+
+    stats = dict()
+    stats['windows'] = windows
+    stats['total_time'] = total_time
+    stats['periods'] = nT
+    stats['periods_per_second'] = nT/total_time
+    stats['cost'] = sum(w['cost'] for w in windows)
+
+    return committed, stats
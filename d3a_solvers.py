@@ -0,0 +1,107 @@
+import os
+from pyomo.environ import SolverFactory
+
+
+
+# Solver backends for solve_model()
+#
+# name:      Pyomo SolverFactory name
+# in_memory: the model is passed to the solver in-process, no LP/solution files are written
+# options:   solver option names for the generic options
+#            'threads', 'time_limit' (s), 'feasibility_tolerance' and 'optimality_tolerance'
+#
+# Any other SolverFactory name can be used as solver, its options are passed unchanged.
+
+
+SOLVER_BACKENDS = {
+    'glpk':   {'name': 'glpk', 'executable': '/usr/bin/glpsol', 'in_memory': False,
+               'options': {'time_limit': 'tmlim'}},
+    'cbc':    {'name': 'cbc', 'in_memory': False,
+               'options': {'threads': 'threads', 'time_limit': 'sec',
+                           'feasibility_tolerance': 'primalT', 'optimality_tolerance': 'dualT'}},
+    'highs':  {'name': 'appsi_highs', 'in_memory': True,
+               'options': {'threads': 'threads', 'time_limit': 'time_limit',
+                           'feasibility_tolerance': 'primal_feasibility_tolerance', 'optimality_tolerance': 'dual_feasibility_tolerance'}},
+    'gurobi': {'name': 'gurobi_direct', 'in_memory': True,
+               'options': {'threads': 'Threads', 'time_limit': 'TimeLimit',
+                           'feasibility_tolerance': 'FeasibilityTol', 'optimality_tolerance': 'OptimalityTol'}},
+    'cplex':  {'name': 'cplex_direct', 'in_memory': True,
+               'options': {'threads': 'threads', 'time_limit': 'timelimit',
+                           'feasibility_tolerance': 'simplex_tolerances_feasibility', 'optimality_tolerance': 'simplex_tolerances_optimality'}},
+    'xpress': {'name': 'xpress_direct', 'in_memory': True,
+               'options': {'threads': 'threads', 'time_limit': 'maxtime',
+                           'feasibility_tolerance': 'feastol', 'optimality_tolerance': 'optimalitytol'}},
+}
+
+GENERIC_OPTIONS = ['threads', 'time_limit', 'feasibility_tolerance', 'optimality_tolerance']
+
+
+
+def solver_options(solver, options):
+
+    # Translate the generic options to the solver option names of a backend
+    # Generic options the backend does not support are skipped
+
+    if options is None:
+        return {}
+
+    if solver not in SOLVER_BACKENDS:
+        return dict(options)
+
+    names = SOLVER_BACKENDS[solver]['options']
+
+    translated = {}
+    for k, v in options.items():
+        if k in names:
+            translated[names[k]] = v
+        elif k in GENERIC_OPTIONS:
+            print('Option %s is not supported by %s, skipped' % (k, solver))
+        else:
+            translated[k] = v
+
+    return translated
+
+
+
+def get_solver(solver='highs', options=None):
+
+    ## Example
+    # from d3a_solvers import get_solver
+    # from d3a_opti import solve_model
+    #
+    # optimizer = get_solver('highs', {'threads': 4, 'time_limit': 60})
+    # model_instance = solve_model(model_instance, optimizer)
+
+    backend = SOLVER_BACKENDS.get(solver, {'name': solver})
+
+    if 'executable' in backend:
+        optimizer = SolverFactory(backend['name'], executable=backend['executable'])
+    else:
+        optimizer = SolverFactory(backend['name'])
+
+    for k, v in solver_options(solver, options).items():
+        optimizer.options[k] = v
+
+    # appsi solvers have no name, monitor records use it
+    if getattr(optimizer, 'name', None) is None:
+        optimizer.name = backend['name']
+
+    return optimizer
+
+
+
+def available_solvers():
+
+    # Backends of SOLVER_BACKENDS that are installed locally
+
+    available = []
+    for solver, backend in SOLVER_BACKENDS.items():
+        if 'executable' in backend and not os.access(backend['executable'], os.X_OK):
+            continue
+        try:
+            if get_solver(solver).available(exception_flag=False):
+                available.append(solver)
+        except Exception:
+            pass
+
+    return available
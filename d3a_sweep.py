@@ -0,0 +1,132 @@
+import time
+import numpy as np
+import pandas as pd
+
+from pyomo.environ import value
+from pyomo.opt import TerminationCondition
+
+from d3a_opti import d3a_opti, initialize_model, persistent_solver, update_model, d3a_opti_solution
+from d3a_matrix import arrays_model_data, PERIOD_PARAMS
+
+
+
+# Parametric sweeps over tariffs, fees and the carbon price
+#
+# The community is built once as a d3a_opti(mutable=True) instance with a
+# persistent solver. Every point of the sweep only pushes its values into the
+# mutable Params with update_model() and re-solves, the constraint structure is
+# unchanged and the solver starts from the optimal basis of the previous point.
+# Points are solved in the given order, neighbouring values give the closest bases.
+
+
+SWEEP_PARAMS = PERIOD_PARAMS + ['carbon_price']
+
+# Community totals of a point and the (T,) variables they are summed from, energies are in kWh
+SWEEP_RESULTS = {'cost_energy': 'COST_ENERGY',
+                 'cost_grid': 'COST_GRID',
+                 'carbon_emissions': 'CO2',
+                 'energy_buy_community': 'PL2_BUY',
+                 'energy_sell_community': 'PL2_SELL'}
+
+
+
+def _sweep_points(values, param):
+
+    # List of {param: value} dictionaries
+
+    if param is not None:
+        return [{param: v} for v in values]
+
+    points = [dict(p) for p in values]
+    for p in points:
+        unknown = set(p) - set(SWEEP_PARAMS)
+        if len(unknown) > 0:
+            raise ValueError('Parameters %s cannot be swept, use %s' % (sorted(unknown), SWEEP_PARAMS))
+
+    return points
+
+
+
+def d3a_sweep(model_data, values, param = None, solver = 'highs', options = None, solutions = False, mode = 'arrays', verbose = False):
+
+    ## Example
+    # from d3a_input import d3a_opti_input_arrays
+    # from d3a_sweep import d3a_sweep
+    #
+    # a = d3a_opti_input_arrays(data)
+    # df = d3a_sweep(a, np.linspace(0, 0.05, 101), param = 'community_fee')
+    # df = d3a_sweep(a, [a['feedintariff'] - m for m in margins], param = 'feedintariff')
+    # df = d3a_sweep(a, [{'grid_fee': g, 'carbon_price': p} for g in fees for p in [0, 50, 100]])
+    #
+    # values: scalars or (T,) arrays of param, or {param: value} dictionaries when param is None
+    #         param is one of SWEEP_PARAMS, scalars of the tariffs hold for every period,
+    #         parameters missing from a point keep their value of the previous point
+    # carbon_price is in EUR/tCO2 and adds the priced community CO2 emissions to the objective
+    #
+    # df has one row per point with the values of the swept parameters in effect (mean of arrays),
+    # 'objective', 'status' (termination condition of the solver), 'time' and the community totals
+    # of SWEEP_RESULTS, which are only filled for optimal points
+    # solutions=True returns (df, solutions) with d3a_opti_solution() of every point in mode
+
+
+    if None not in model_data:
+        model_data = arrays_model_data(model_data)
+
+    if param is not None and param not in SWEEP_PARAMS:
+        raise ValueError('Parameter %s cannot be swept, use %s' % (param, SWEEP_PARAMS))
+
+    points = _sweep_points(values, param)
+
+    t0 = time.perf_counter()
+    model_instance = initialize_model(d3a_opti(mutable=True), model_data)
+    optimizer = persistent_solver(solver, options)
+    build_time = time.perf_counter() - t0
+
+    nT = len(model_instance.T)
+    dt = value(model_instance.dt)
+
+    swept = list(dict.fromkeys(p for point in points for p in point))
+    effective = {p: float(np.mean(list(model_instance.component(p).extract_values().values()))) for p in swept}
+
+    rows = []
+    point_solutions = []
+    for i, point in enumerate(points):
+
+        t0 = time.perf_counter()
+        update_model(model_instance, **{p: v if p == 'carbon_price' else np.broadcast_to(v, (nT,)) for p, v in point.items()})
+
+        effective.update({p: float(np.mean(v)) for p, v in point.items()})
+        r = dict(effective)
+        optimal = False
+        try:
+            results = optimizer.solve(model_instance, load_solutions=False)
+            r['status'] = str(results.solver.termination_condition)
+            optimal = results.solver.termination_condition == TerminationCondition.optimal
+        except Exception as e:
+            r['status'] = str(e).splitlines()[0] if str(e) else type(e).__name__
+
+        if optimal:
+            optimizer.load_vars()
+            r['objective'] = value(model_instance.total_cost)
+            for k, v in SWEEP_RESULTS.items():
+                r[k] = sum(x.value for x in model_instance.component(v).values())
+            r['energy_buy_community'] *= dt
+            r['energy_sell_community'] *= dt
+            if solutions:
+                point_solutions.append(d3a_opti_solution(model_instance, mode))
+        elif solutions:
+            point_solutions.append(None)
+
+        r['time'] = time.perf_counter() - t0
+        rows.append(r)
+
+        if verbose:
+            print('Point %d/%d: %s %s, %.3f s' % (i + 1, len(points), point if param is None else r[param], r['status'], r['time']))
+
+    df = pd.DataFrame(rows, columns=swept + ['objective'] + list(SWEEP_RESULTS) + ['status', 'time'])
+    df.attrs['build_time'] = build_time
+
+    if solutions:
+        return df, point_solutions
+
+    return df
@@ -0,0 +1,227 @@
+import os
+import math
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from d3a_matrix import d3a_opti_matrix, solve_matrix_model, matrix_variables, variables_solution
+from d3a_matrix import model_data_arrays, slice_arrays, PERIOD_PARAMS, VARIABLES
+from d3a_aggregate import aggregate_members
+
+
+
+# Temporal decomposition of long d3a_opti runs
+#
+# Periods are only coupled through BEL[t-1,b] in battery_soc, so the horizon is
+# split into blocks that are solved in parallel with the battery level fixed at
+# the block boundaries (fixed-boundary heuristic). The boundary levels are the
+# initial level, or with boundary='coarse' the levels of a coarse-resolution solve
+# of the full horizon. The coarse LP has the members without battery power
+# aggregated (aggregate_members) and steps of at least coarse_hours, long enough
+# that it has no more periods than a block, so it is no larger than a block LP
+# (unless the horizon has more than block_periods**2 periods). Coarse levels
+# usually lower the cost but are not guaranteed to. The optional refinement passes
+# re-solve blocks shifted by half a block length with the boundary levels of the
+# previous pass, which can only lower the cost.
+# Only one block LP per worker is held in memory at a time.
+#
+# level[k] is the battery level at the end of period k-1, level[0] = bel_ini_level
+
+
+
+def _coarse_arrays(a, k):
+
+    # Average every k periods into one period of length k*dt
+
+    nT = len(a['T'])
+    groups = np.arange(0, nT, k)
+    counts = np.diff(np.append(groups, nT))
+
+    c = dict(a)
+    c['T'] = np.arange(1, len(groups) + 1)
+    c['demand'] = np.add.reduceat(a['demand'], groups, axis=0)/counts[:, None] if a['demand'].shape[1] > 0 else a['demand'][groups]
+    c['generation'] = np.add.reduceat(a['generation'], groups, axis=0)/counts[:, None] if a['generation'].shape[1] > 0 else a['generation'][groups]
+    for p in PERIOD_PARAMS:
+        c[p] = np.add.reduceat(a[p], groups)/counts
+    c['dt'] = a['dt']*k
+
+    return c
+
+
+
+def _solve_block(w, bel_fin, options):
+
+    lp = d3a_opti_matrix(w)
+
+    # Fix the battery level at the end of the block
+    if bel_fin is not None and len(lp['B']) > 0:
+        nT, nB = len(lp['T']), len(lp['B'])
+        i = lp['layout']['BEL'] + (nT - 1)*nB + np.arange(nB)
+        lp['lb'][i] = bel_fin
+        lp['ub'][i] = bel_fin
+
+    lp = solve_matrix_model(lp, options)
+    if lp['x'] is None:
+        raise RuntimeError('Block solve failed: %s' % lp['message'])
+
+    return matrix_variables(lp), lp['objective']
+
+
+
+def _solve_blocks(a, edges, level, executor, options):
+
+    blocks = []
+    for s, e in zip(edges[:-1], edges[1:]):
+        w = slice_arrays(a, s, e)
+        w['bel_ini_level'] = level[s]
+        bel_fin = level[e] if e < len(a['T']) else None
+        blocks.append((w, bel_fin, options))
+
+    if executor is None:
+        results = [_solve_block(*b) for b in blocks]
+    else:
+        results = list(executor.map(_solve_block, *zip(*blocks)))
+
+    variables = {v: np.concatenate([r[0][v] for r in results], axis=0) for v in VARIABLES}
+    objective = sum(r[1] for r in results)
+
+    return variables, objective
+
+
+
+def _levels(variables, bel_ini):
+
+    # Battery level at every period boundary from a full horizon solution
+
+    bel = variables['BEL']
+    return np.vstack([np.asarray(bel_ini, dtype=float)[None, :], np.maximum(bel, 0.0)])
+
+
+
+def _coarse_step(L, nT, coarse_hours, dt):
+
+    # Smallest divisor of the block length L of at least coarse_hours and nT/L periods
+
+    k = min(max(int(round(coarse_hours/dt)), math.ceil(nT/L), 1), L)
+
+    return min(d for d in range(k, L + 1) if L % d == 0)
+
+
+
+def _coarse_levels(a, k, options):
+
+    # Battery levels at every k-th period boundary from a coarse solve with the
+    # members without battery power aggregated, and the coarse objective
+
+    c = _coarse_arrays(a, k)
+    try:
+        c, reduction = aggregate_members(c)
+        batteries = reduction['batteries']
+    except ValueError:
+        batteries = list(a['B'])
+
+    lp = solve_matrix_model(d3a_opti_matrix(c), options)
+    if lp['x'] is None:
+        raise RuntimeError('Coarse solve failed: %s' % lp['message'])
+
+    # Batteries without power keep their initial level
+    bel = matrix_variables(lp)['BEL']
+    position = {b: i for i, b in enumerate(batteries)}
+    level = np.repeat(np.asarray(a['bel_ini_level'], dtype=float)[None, :], bel.shape[0] + 1, axis=0)
+    for j, b in enumerate(a['B']):
+        if b in position:
+            level[1:, j] = np.maximum(bel[:, position[b]], 0.0)
+
+    return level, lp['objective']
+
+
+
+def d3a_opti_temporal(model_data, block_hours=24*7, boundary='initial', coarse_hours=2, refine=1, workers=None, compare=False, options=None):
+
+    ## Example
+    # from d3a_input import d3a_opti_input
+    # from d3a_temporal import d3a_opti_temporal
+    #
+    # model_data = d3a_opti_input(data)
+    # s, stats = d3a_opti_temporal(model_data, block_hours=24*7, refine=1, workers=8, compare=True)
+    #
+    # boundary = 'initial'/'coarse', coarse_hours is the shortest coarse step
+    # s has the structure of d3a_opti_solution(),
+    # stats['gap'] is the relative cost gap to the monolithic solve when compare=True
+
+
+    if None in model_data:
+        a = model_data_arrays(model_data)
+    else:
+        a = model_data
+
+    nT = len(a['T'])
+    nB = len(a['B'])
+    L = max(int(round(block_hours/a['dt'])), 1)
+
+    stats = {'blocks': math.ceil(nT/L), 'block_periods': L, 'passes': []}
+
+    if workers is None:
+        workers = os.cpu_count()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    try:
+
+        ## BOUNDARY LEVELS
+        t0 = time.perf_counter()
+        if boundary == 'coarse' and nB > 0:
+            # Coarse steps aligned with the block edges
+            k = _coarse_step(L, nT, coarse_hours, a['dt'])
+            coarse_level, coarse_objective = _coarse_levels(a, k, options)
+
+            level = np.repeat(np.asarray(a['bel_ini_level'], dtype=float)[None, :], nT + 1, axis=0)
+            grid = np.arange(0, nT + 1, k)
+            level[grid] = coarse_level[:len(grid)]
+            stats['coarse_periods'] = len(coarse_level) - 1
+            stats['passes'].append({'pass': 'coarse', 'time': time.perf_counter() - t0, 'objective': coarse_objective})
+        elif boundary in ['coarse', 'initial']:
+            level = np.repeat(np.asarray(a['bel_ini_level'], dtype=float)[None, :], nT + 1, axis=0)
+        else:
+            raise ValueError('Unknown boundary option: %s' % boundary)
+
+
+        ## FIXED-BOUNDARY BLOCKS
+        t0 = time.perf_counter()
+        edges = list(range(0, nT, L)) + [nT]
+        variables, objective = _solve_blocks(a, edges, level, executor, options)
+        stats['passes'].append({'pass': 'blocks', 'time': time.perf_counter() - t0, 'objective': objective})
+
+
+        ## REFINEMENT
+        # Blocks shifted by half a block length, interior edges of the previous pass are freed
+        for i in range(refine):
+            if nB == 0 or L < 2 or nT <= L:
+                break
+            t0 = time.perf_counter()
+            level = _levels(variables, a['bel_ini_level'])
+            shift = L//2 if i % 2 == 0 else 0
+            edges = [0] + list(range(shift if shift > 0 else L, nT, L)) + [nT]
+            variables, objective = _solve_blocks(a, edges, level, executor, options)
+            stats['passes'].append({'pass': 'refine %d' % (i + 1), 'time': time.perf_counter() - t0, 'objective': objective})
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    stats['objective'] = objective
+    stats['time'] = sum(p['time'] for p in stats['passes'])
+
+
+    ## MONOLITHIC REFERENCE
+    if compare:
+        t0 = time.perf_counter()
+        lp = solve_matrix_model(d3a_opti_matrix(a), options)
+        stats['monolithic_time'] = time.perf_counter() - t0
+        stats['monolithic_objective'] = lp['objective']
+        if lp['objective'] is not None:
+            stats['gap'] = (objective - lp['objective'])/max(abs(lp['objective']), 1e-9)
+
+
+    s = variables_solution(variables, a['H'], a['B'])
+
+    return s, stats
@@ -1,8 +1,28 @@
-import requests
+import os
+import json
+import hashlib
 import pandas as pd 
+from concurrent.futures import ThreadPoolExecutor
 
+from httpsession import get_session
 
-def get_pv_generation_data(parameters):
+
+API_URL = 'https://energydatamap.com/api/solar'
+
+# The generation is linear in capacity_kw, cached profiles are the API response for
+# REFERENCE_CAPACITY kW (precision of the API values) and scaled to capacity_kw
+REFERENCE_CAPACITY = 1000
+
+# Fields of the API response scaled with capacity_kw, None scales every numeric column
+GENERATION_COLUMNS = None
+
+# Concurrent requests of get_pv_generation_batch(), per request timeout (s) and retries of failed requests
+MAX_WORKERS = 8
+TIMEOUT = 120
+RETRIES = 3
+
+
+def get_pv_generation_data(parameters, cache_dir = None, columns = GENERATION_COLUMNS):
     
     # Parameter value range
     # latitude: -90 to 90
@@ -21,22 +41,135 @@ def get_pv_generation_data(parameters):
     #         'end_date': '2020-01-31','frequency': '15min'}    
     
     # df = get_pv_generation_data(parameters)
-    
 
-    url = 'https://energydatamap.com/api/solar'            
+    # With cache_dir the profile of the other parameters is downloaded once,
+    # kept as Parquet in cache_dir and scaled to capacity_kw
+    # df = get_pv_generation_data(parameters, cache_dir = 'pv_cache')
+    #
+    # columns: fields scaled with capacity_kw, the other fields are returned as downloaded
+    # df = get_pv_generation_data(parameters, cache_dir = 'pv_cache', columns = ['pv_generation'])
     
-    print('Calling API for data generation')        
-    r = requests.get(url, params=parameters)
 
+    if cache_dir is not None:
+        profile = _get_profile(parameters, cache_dir)
+        if profile is None:
+            return
+        return _scale(profile, parameters['capacity_kw']/REFERENCE_CAPACITY, columns)
 
-    if r.status_code == 200:
-        d = r.json()
-        # Convert to dataframe
-        df = pd.DataFrame(d).set_index('valid_datetime')
-        df.index = pd.to_datetime(df.index)
-    else:
+    print('Calling API for data generation')        
+    status_code, df = _get_generation(parameters)
+
+    if status_code != 200:
         print('API problem in data generation')
-        print('Status code:',r.status_code)
+        print('Status code:',status_code)
         return
                     
-    return df
\ No newline at end of file
+    return df
+
+
+
+def get_pv_generation_batch(parameter_list, cache_dir = None, max_workers = MAX_WORKERS, columns = GENERATION_COLUMNS):
+
+    ## Example
+    # from energydatamap import get_pv_generation_batch
+    #
+    # parameter_list = [dict(parameters, capacity_kw = c) for c in range(10, 500, 10)]
+    # dfs = get_pv_generation_batch(parameter_list, cache_dir = 'pv_cache')
+
+    # One DataFrame per parameters in parameter_list (None when the API call failed).
+    # Parameters that only differ in capacity_kw share one download, the 
+    # profiles are downloaded with max_workers concurrent requests.
+    # columns are the fields scaled with capacity_kw as in get_pv_generation_data().
+
+    keys = [_profile_key(parameters) for parameters in parameter_list]
+    unique = {}
+    for key, parameters in zip(keys, parameter_list):
+        unique.setdefault(key, parameters)
+
+    print('Calling API for data generation')        
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(unique)), 1)) as executor:
+        futures = {key: executor.submit(_get_profile, parameters, cache_dir) for key, parameters in unique.items()}
+        profiles = {key: f.result() for key, f in futures.items()}
+
+    return [_scale(profiles[key], parameters['capacity_kw']/REFERENCE_CAPACITY, columns) if profiles[key] is not None else None 
+            for key, parameters in zip(keys, parameter_list)]
+
+
+
+def _get_generation(parameters):
+
+    # (status code, DataFrame) of one API call
+
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(API_URL, params=parameters, timeout=TIMEOUT)
+
+    if r.status_code != 200:
+        return r.status_code, None
+
+    d = r.json()
+    # Convert to dataframe
+    df = pd.DataFrame(d).set_index('valid_datetime')
+    df.index = pd.to_datetime(df.index)
+
+    return 200, df
+
+
+
+def _profile_key(parameters):
+
+    # Parameters other than capacity_kw
+
+    return json.dumps({k: v for k, v in parameters.items() if k != 'capacity_kw'}, sort_keys=True, default=str)
+
+
+
+def _get_profile(parameters, cache_dir = None):
+
+    # API response of the parameters for REFERENCE_CAPACITY kW, from cache_dir or the API
+
+    key = _profile_key(parameters)
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'pv_%dkw_%s.parquet' % (REFERENCE_CAPACITY, hashlib.sha1(key.encode()).hexdigest()[:16]))
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+
+    status_code, df = _get_generation(dict(parameters, capacity_kw=REFERENCE_CAPACITY))
+    if status_code != 200:
+        print('API problem in data generation')
+        print('Status code:',status_code)
+        return
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_parquet(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    return df
+
+
+
+def generation_columns(df, columns = GENERATION_COLUMNS):
+
+    # Fields of df scaled with capacity_kw, the numeric columns when columns is None
+
+    if columns is None:
+        return [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+
+    missing = [c for c in columns if c not in df.columns]
+    if len(missing) > 0:
+        raise KeyError('No %s columns in the generation data, columns: %s' % (missing, list(df.columns)))
+
+    return list(columns)
+
+
+
+def _scale(df, factor, columns = GENERATION_COLUMNS):
+
+    # Generation columns multiplied by factor
+
+    df = df.copy()
+    for c in generation_columns(df, columns):
+        df[c] = df[c]*factor
+
+    return df
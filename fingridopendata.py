@@ -15,12 +15,31 @@
 # 503 	The variable is currently on maintenance break
 
 
-import requests
+import os
+import json
 import pandas as pd 
-from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
 
+from httpsession import get_session
 
-def get_open_data(api_key, variable_id, start_time, end_time, api_version = 'v1'):
+
+API_URL = 'https://api.fingrid.fi/{}/variable/{}/events/json'
+API_URL_LATEST = 'https://api.fingrid.fi/{}/variable/{}/event/json'
+
+# Time resolution of the variables in minutes, unknown variables are assumed to be real time data
+VARIABLE_RESOLUTION = {74: 60, 124: 60, 192: 3, 193: 3, 265: 3, 266: 3}
+DEFAULT_RESOLUTION = 3
+
+# Rows per request, longer periods are split into chunks of ROW_LIMIT rows
+ROW_LIMIT = 20000
+
+# Concurrent requests, per request timeout (s) and retries of failed or rate limited requests
+MAX_WORKERS = 4
+TIMEOUT = 60
+RETRIES = 5
+
+
+def get_open_data(api_key, variable_id, start_time, end_time, api_version = 'v1', max_workers = MAX_WORKERS, store_dir = None):
     
     
     ## Example
@@ -33,88 +52,224 @@ def get_open_data(api_key, variable_id, start_time, end_time, api_version = 'v1'
     #
     # df = get_open_data(api_key, variableid, start_time, end_time)    
 
+    # Periods longer than ROW_LIMIT rows of the variable are fetched in chunks 
+    # with max_workers concurrent requests, a chunk answered with 416 is split in two
+
+    # With store_dir the data is kept in a local store, only the parts of the
+    # period that are not stored yet are downloaded
+    # df = get_open_data(api_key, variableid, start_time, end_time, store_dir = 'fingrid_store')
+
     
     # Convert datetime string
     t1 = pd.to_datetime(start_time)
     t2 = pd.to_datetime(end_time)
 
-    s1 = t1.strftime("%Y-%m-%dT%H:%M:%SZ")
-    s2 = t2.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-    
-    url = 'https://api.fingrid.fi/{}/variable/{}/events/json'.format(api_version, variable_id)
+    url = API_URL.format(api_version, variable_id)
     
     headers = {"x-api-key": api_key}
-    parameters = {'start_time': s1, \
-                  'end_time': s2} 
+
+    if store_dir is None:
+        status_code, df = _get_period(url, headers, variable_id, t1, t2, max_workers)
+    else:
+        status_code, df = _get_stored(store_dir, url, headers, variable_id, t1, t2, max_workers)
+
+    if status_code != 200:
+        print('API call issue')
+        print('Status code:', status_code)
+        return
+
+    if df is None:
+        print('No data for this period')
+        return
+                    
+    return df
+
+
+
+def get_open_data_multi(api_key, variable_ids, start_time, end_time, dt = None, api_version = 'v1', max_workers = MAX_WORKERS, store_dir = None):
+
+
+    ## Example
+    # from fingridopendata import get_open_data_multi
+    #
+    # api_key = 'your_api_key'
+    # variable_ids = [74, 124, 265]
+    # start_time = 'yyyy-MM-dd HH:mm'
+    # end_time = 'yyyy-MM-dd HH:mm'  
+    #
+    # df = get_open_data_multi(api_key, variable_ids, start_time, end_time, dt = 0.25)
+
+    # The variables are fetched concurrently, df has one column per variable id 
+    # on a common start_time (UTC) index. With dt (h) the variables are resampled 
+    # to dt, averaged over finer and repeated over coarser time resolutions.
+
+
+    # Convert datetime string
+    t1 = pd.to_datetime(start_time)
+    t2 = pd.to_datetime(end_time)
     
-    print('Calling API ...')        
-    r = requests.get(url, params=parameters, headers=headers)
+    headers = {"x-api-key": api_key}
 
-    # r.url
+    workers = max(max_workers//max(len(variable_ids), 1), 1)
+    args = [(API_URL.format(api_version, v), headers, v, t1, t2, workers) for v in variable_ids]
 
+    with ThreadPoolExecutor(max_workers=max(len(variable_ids), 1)) as executor:
+        if store_dir is None:
+            futures = [executor.submit(_get_period, *a) for a in args]
+        else:
+            futures = [executor.submit(_get_stored, store_dir, *a) for a in args]
+        results = [f.result() for f in futures]
 
-    if r.status_code == 200:
-        
-        d = r.json()
-        # Convert to dataframe
-        if len(d)==0:
-            print('No data for this period')
+    columns = []
+    for v, (status_code, df) in zip(variable_ids, results):
+        if status_code != 200:
+            print('API call issue')
+            print('Variable id:', v)
+            print('Status code:', status_code)
             return
-        else:
-            df = pd.DataFrame(d)
-            df['start_time'] =  pd.to_datetime(df['start_time'])
-            df['end_time'] =  pd.to_datetime(df['end_time'])
-            df = df.set_index(['start_time','end_time'])
-        
-    elif r.status_code == 416:
-        
-        dfs = []
-        while t1 < t2:
-            
-            t = t1 + relativedelta(months=+6)
-            
-            s1 = t1.strftime("%Y-%m-%dT%H:%M:%SZ")
-            s2 = t.strftime("%Y-%m-%dT%H:%M:%SZ")
-        
-        
-            parameters = {'start_time': s1, \
-                          'end_time': s2} 
-            
-               
-            r = requests.get(url, params=parameters, headers=headers)
-            
-            t1 = t
-            
-            if r.status_code == 200:
-                d = r.json()
-                # Convert to dataframe
-                if len(d)>0:
-                    df = pd.DataFrame(d)
-                    df['start_time'] =  pd.to_datetime(df['start_time'])
-                    df['end_time'] =  pd.to_datetime(df['end_time'])
-                    df = df.set_index(['start_time','end_time'])
-                
-                    dfs.append(df)
-            
-            else:
-                print('API call issue')
-                print('Status code:',r.status_code)
-                return
-        
-        df = pd.concat(dfs)
-        df = df[~df.index.duplicated(keep='first')] # Remove index dublicated times
-        df = df[df.index.get_level_values(0).tz_localize(None) <= t2] # Remove rows with timestamp > t2
+
+        if df is None:
+            continue
+
+        s = df['value'].droplevel('end_time').rename(v)
+        if dt is not None:
+            s = _resample(s, pd.Timedelta(hours=dt), _resolution(v))
+        columns.append(s)
+
+    if len(columns) == 0:
+        print('No data for this period')
+        return
+
+    df = pd.concat(columns, axis=1).reindex(columns=[v for v in variable_ids if v in [s.name for s in columns]])
+    df.index.name = 'start_time'
+
+    return df
+
+
+
+def _resample(s, step, resolution):
+
+    if resolution > step:
+        # Values hold for the whole resolution step
+        return s.resample(step).ffill(limit=int(resolution/step) - 1)
+
+    return s.resample(step).mean()
+
+
+
+def _get_period(url, headers, variable_id, t1, t2, max_workers, closed = True):
+
+    # Events of t1 <= start_time <= t2 (< t2 when not closed) as (status code, DataFrame)
+
+    chunks = _chunks(t1, t2, _chunk_length(variable_id))
     
+    print('Calling API ...')        
+    if max_workers <= 1 or len(chunks) == 1:
+        results = [_get_chunk(url, headers, c1, c2, closed and c2 == t2) for c1, c2 in chunks]
     else:
-        print('API call issue')
-        print('Status code:',r.status_code)
-        return
-                    
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [executor.submit(_get_chunk, url, headers, c1, c2, closed and c2 == t2) for c1, c2 in chunks]
+            results = [f.result() for f in futures]
+
+    for status_code, df in results:
+        if status_code != 200:
+            return status_code, None
+
+    # Chunks are in time order and do not overlap
+    dfs = [df for status_code, df in results if df is not None]
+    if len(dfs) == 0:
+        return 200, None
+
+    return 200, pd.concat(dfs) if len(dfs) > 1 else dfs[0]
+
+
+
+def _resolution(variable_id):
+
+    return pd.Timedelta(minutes=VARIABLE_RESOLUTION.get(int(variable_id), DEFAULT_RESOLUTION))
+
+
+
+def _chunk_length(variable_id):
+
+    return _resolution(variable_id)*ROW_LIMIT
+
+
+
+def _chunks(t1, t2, length):
+
+    edges = [t1]
+    while edges[-1] + length < t2:
+        edges.append(edges[-1] + length)
+    edges.append(t2)
+
+    return list(zip(edges[:-1], edges[1:]))
+
+
+
+def _get_chunk(url, headers, t1, t2, last):
+
+    # Events of t1 <= start_time < t2 (<= t2 for the last chunk) as (status code, DataFrame)
+    # The DataFrame is None when there is no data
+
+    parameters = {'start_time': t1.strftime("%Y-%m-%dT%H:%M:%SZ"), \
+                  'end_time': t2.strftime("%Y-%m-%dT%H:%M:%SZ")} 
+
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, params=parameters, headers=headers, timeout=TIMEOUT)
+
+    if r.status_code == 416 and t2 - t1 > pd.Timedelta(minutes=1):
+        # Still too many rows, split the chunk in two
+        tm = t1 + (t2 - t1)/2
+        status_1, df_1 = _get_chunk(url, headers, t1, tm, False)
+        status_2, df_2 = _get_chunk(url, headers, tm, t2, last)
+        if status_1 != 200:
+            return status_1, None
+        if status_2 != 200:
+            return status_2, None
+        dfs = [df for df in [df_1, df_2] if df is not None]
+        return 200, pd.concat(dfs) if len(dfs) > 0 else None
+
+    if r.status_code != 200:
+        return r.status_code, None
+
+    d = r.json()
+    if len(d) == 0:
+        return 200, None
+
+    df = _events_frame(d)
+
+    # API limits are inclusive, keep the end point only in the last chunk
+    start = _start_times(df)
+    df = df[start <= t2] if last else df[start < t2]
+
+    return 200, df if len(df) > 0 else None
+
+
+
+def _start_times(df):
+
+    # start_time level of the index as naive UTC times
+
+    start = df.index.get_level_values(0)
+    if start.tz is not None:
+        start = start.tz_convert('UTC').tz_localize(None)
+
+    return start
+
+
+
+def _events_frame(d):
+
+    # Convert to dataframe
+    df = pd.DataFrame(d)
+    df['start_time'] =  pd.to_datetime(df['start_time'])
+    df['end_time'] =  pd.to_datetime(df['end_time'])
+    df = df.set_index(['start_time','end_time'])
+
     return df
 
 
-def get_open_data_latest(api_key, variable_id, api_version = 'v1'):
+def get_open_data_latest(api_key, variable_id, api_version = 'v1', store_dir = None):
 
 
     ## Example
@@ -124,29 +279,206 @@ def get_open_data_latest(api_key, variable_id, api_version = 'v1'):
     # variable_id = 265   
     #
     # d = get_open_data_latest(api_key, variable_id)
+    #
+    # With store_dir the latest event is added to the local store of get_open_data()
+    # d = get_open_data_latest(api_key, variable_id, store_dir = 'fingrid_store')
     
  
-    url = 'https://api.fingrid.fi/{}/variable/{}/event/json'.format(api_version, variable_id)
+    url = API_URL_LATEST.format(api_version, variable_id)
     
     
     headers = {"x-api-key": api_key}
     
     print('Calling API ...')        
-    r = requests.get(url, headers=headers)
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, headers=headers, timeout=TIMEOUT)
 
     # r.url
 
 
     if r.status_code == 200:
         d = r.json() 
-        # Convert to dataframe
-        df = pd.DataFrame([d])
-        df['start_time'] =  pd.to_datetime(df['start_time'])
-        df['end_time'] =  pd.to_datetime(df['end_time'])
-        df = df.set_index(['start_time','end_time'])       
+        df = _events_frame([d])
+        if store_dir is not None:
+            _store_latest(store_dir, variable_id, df)
     else:
         print('API call issue')
         print('Status code:',r.status_code)
         return
                     
-    return df
\ No newline at end of file
+    return df
+
+
+
+## LOCAL STORE
+# store_dir/<variable_id>/ holds the events as Parquet parts named by the first and 
+# last start_time of the part (no overlap between parts) and intervals.json, the 
+# intervals of start_time (UTC) already downloaded. Parts are merged into one when 
+# there are more than STORE_MAX_PARTS. Intervals ending less than STORE_OPEN_PERIOD 
+# ago are only stored up to the last event received, later events are fetched again.
+
+STORE_MAX_PARTS = 32
+STORE_OPEN_PERIOD = pd.Timedelta(days=1)
+
+TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+
+
+def stored_intervals(store_dir, variable_id):
+
+    # Downloaded (first, last) start_time intervals of a variable
+
+    path = os.path.join(store_dir, str(variable_id), 'intervals.json')
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return [(pd.Timestamp(t1), pd.Timestamp(t2)) for t1, t2 in json.load(f)]
+
+
+
+def _get_stored(store_dir, url, headers, variable_id, t1, t2, max_workers):
+
+    # Download the gaps of the store in t1 ... t2 and read the period from the store
+
+    intervals = stored_intervals(store_dir, variable_id)
+    step = _resolution(variable_id)
+    now = pd.Timestamp.now('UTC').tz_localize(None)
+
+    for lo, hi, lo_open, hi_open in _gaps(intervals, t1, t2):
+        if lo_open and hi_open and hi - lo <= step:
+            continue
+
+        status_code, df = _get_period(url, headers, variable_id, lo, hi, max_workers, closed = not hi_open)
+        if status_code != 200:
+            return status_code, None
+
+        # The open ends are stored already
+        if df is not None and lo_open:
+            df = df[_start_times(df) > lo]
+            if len(df) == 0:
+                df = None
+
+        # Recent events may still be missing from the API
+        if hi > now - STORE_OPEN_PERIOD:
+            if df is None:
+                continue
+            hi = _start_times(df)[-1]
+
+        _store_append(store_dir, variable_id, df, lo, hi)
+
+    return 200, _read_store(store_dir, variable_id, t1, t2)
+
+
+
+def _gaps(intervals, t1, t2):
+
+    # (lo, hi, lo_open, hi_open) periods of t1 ... t2 not covered by the sorted intervals
+
+    gaps = []
+    t = t1
+    t_open = False
+    for lo, hi in intervals:
+        if hi < t:
+            continue
+        if lo > t2:
+            break
+        if lo > t:
+            gaps.append((t, lo, t_open, True))
+        t = hi
+        t_open = True
+        if t >= t2:
+            break
+
+    if t < t2 or not t_open:
+        gaps.append((t, t2, t_open, False))
+
+    return gaps
+
+
+
+def _merge_intervals(intervals, step):
+
+    # Intervals less than one time step apart have no events between them
+
+    merged = []
+    for lo, hi in sorted(intervals):
+        if len(merged) > 0 and lo <= merged[-1][1] + step:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+
+    return merged
+
+
+
+def _store_append(store_dir, variable_id, df, lo, hi):
+
+    path = os.path.join(store_dir, str(variable_id))
+    os.makedirs(path, exist_ok=True)
+
+    if df is not None:
+        start = _start_times(df)
+        df.to_parquet(os.path.join(path, '%s_%s.parquet' % (start[0].strftime(TIME_FORMAT), start[-1].strftime(TIME_FORMAT))))
+
+    intervals = _merge_intervals(stored_intervals(store_dir, variable_id) + [(lo, hi)], _resolution(variable_id))
+
+    # Replace the interval file only after the data is written
+    with open(os.path.join(path, 'intervals.json.tmp'), 'w') as f:
+        json.dump([[t1.isoformat(), t2.isoformat()] for t1, t2 in intervals], f)
+    os.replace(os.path.join(path, 'intervals.json.tmp'), os.path.join(path, 'intervals.json'))
+
+    parts = _store_parts(path)
+    if len(parts) > STORE_MAX_PARTS:
+        df = pd.concat([pd.read_parquet(os.path.join(path, p[2])) for p in parts])
+        start = _start_times(df)
+        df.to_parquet(os.path.join(path, 'merged.parquet.tmp'))
+        for p in parts:
+            os.remove(os.path.join(path, p[2]))
+        os.replace(os.path.join(path, 'merged.parquet.tmp'), 
+                   os.path.join(path, '%s_%s.parquet' % (start[0].strftime(TIME_FORMAT), start[-1].strftime(TIME_FORMAT))))
+
+
+
+def _store_latest(store_dir, variable_id, df):
+
+    t = _start_times(df)[0]
+    for lo, hi in stored_intervals(store_dir, variable_id):
+        if lo <= t <= hi:
+            return
+
+    _store_append(store_dir, variable_id, df, t, t)
+
+
+
+def _store_parts(path):
+
+    # (first, last, file name) of the parts in time order
+
+    parts = []
+    for name in os.listdir(path):
+        if name.endswith('.parquet'):
+            t1, t2 = name[:-len('.parquet')].split('_')
+            parts.append((pd.Timestamp(t1), pd.Timestamp(t2), name))
+
+    return sorted(parts)
+
+
+
+def _read_store(store_dir, variable_id, t1, t2):
+
+    # Events of t1 <= start_time <= t2, only the parts overlapping the period are read
+
+    path = os.path.join(store_dir, str(variable_id))
+    if not os.path.exists(path):
+        return
+
+    dfs = [pd.read_parquet(os.path.join(path, name)) for first, last, name in _store_parts(path) if last >= t1 and first <= t2]
+    if len(dfs) == 0:
+        return
+
+    df = pd.concat(dfs) if len(dfs) > 1 else dfs[0]
+
+    start = _start_times(df)
+    df = df.iloc[start.searchsorted(t1, side='left'):start.searchsorted(t2, side='right')]
+
+    return df if len(df) > 0 else None
@@ -0,0 +1,59 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+
+# Pooled HTTP session with retries shared by the data source modules
+#
+# Connection errors and the status codes in RETRY_STATUS are retried with
+# exponential backoff (backoff * 2^n s), a Retry-After header is respected.
+# get_session() creates one session per set of arguments on first use and
+# returns the same session afterwards, so every module reuses its connections.
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+
+def get_session(pool_size=10, retries=3, backoff=0.5, status_forcelist=RETRY_STATUS):
+
+    ## Example
+    # from httpsession import get_session
+    #
+    # session = get_session(pool_size=8)
+    # r = session.get(url, params=parameters, timeout=60)
+
+    key = (pool_size, retries, backoff, tuple(status_forcelist))
+
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = _new_session(pool_size, retries, backoff, status_forcelist)
+
+    return _sessions[key]
+
+
+
+def _new_session(pool_size, retries, backoff, status_forcelist):
+
+    retry = Retry(total=retries,
+                  connect=retries,
+                  read=retries,
+                  status=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=status_forcelist,
+                  allowed_methods=['GET'],
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
@@ -1,10 +1,36 @@
 # https://www.nordpoolgroup.com/historical-market-data/
 
+import io
+import os
+import time
 import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
+from httpsession import get_session
 
-def get_elspot_prices(start_time, end_time, regions = [], currency = 'EUR'):
+
+# Yearly market data files, can be pointed to local copies of the files
+DATA_URLS = {'elspot-prices': 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/elspot-prices_%s_hourly_%s.xls',
+             'elspot-volumes': 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/elspot-volumes_%s_hourly.xls',
+             'regulating-prices': 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/regulating-prices_%s_hourly_%s.xls',
+             'regulating-volumes': 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/regulating-volumes_%s_hourly.xls'}
+
+HEADER_ROWS = {'elspot-prices': 0,
+               'elspot-volumes': 0,
+               'regulating-prices': [0, 1],
+               'regulating-volumes': [0, 1]}
+
+# Cached years that were still open when cached are downloaded again after this age (s)
+CURRENT_YEAR_MAX_AGE = 3600
+
+# Concurrent downloads, per request timeout (s) and retries of failed requests
+MAX_WORKERS = 8
+TIMEOUT = 60
+RETRIES = 3
+
+
+def get_elspot_prices(start_time, end_time, regions = [], currency = 'EUR', cache_dir = None):
 
     ## Example
     # from nordpool import get_elspot_prices
@@ -14,50 +40,87 @@ def get_elspot_prices(start_time, end_time, regions = [], currency = 'EUR'):
     # regions = ['SE1']
     # currency = 'EUR' # 'EUR','SEK','NOK','DKK'
     # df = get_elspot_prices(start_time, end_time, regions = regions, currency = currency)  
+    #
+    # Parsed years are kept as Parquet files in cache_dir, closed years are only downloaded once
+    # df = get_elspot_prices(start_time, end_time, regions = regions, currency = currency, cache_dir = 'nordpool_cache')
 
+    return get_data('elspot-prices', start_time, end_time, regions, currency, cache_dir)
 
-    data_url = 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/elspot-prices_%s_hourly_%s.xls'
 
-    t1 = pd.to_datetime(start_time).tz_localize('UTC')
-    t2 = pd.to_datetime(end_time).tz_localize('UTC') 
 
-    t1_year = t1.tz_convert('CET').year
-    t2_year = t2.tz_convert('CET').year
+def get_elspot_volumes(start_time, end_time, regions = [], cache_dir = None):
 
-    years = np.arange(t1_year, t2_year+1)
+    return get_data('elspot-volumes', start_time, end_time, regions, None, cache_dir)
 
-    urls = [data_url % (year, currency.lower()) for year in years]
 
-    # Download data
-    df_update = []
-    for url in urls:
-        df_update_yr = pd.read_html(url, skiprows=2, header=0, index_col=[0, 1], decimal=',', thousands=' ')[0]
-        time_vector = pd.to_datetime(df_update_yr.reset_index().apply(lambda r: '%s %s:00' % (r[0], r[1][:2]), axis=1), format="%d-%m-%Y %H:%M")
-        df_update_yr.set_index(time_vector, inplace=True)
-        df_update.append(df_update_yr)
-    df_update = pd.concat(df_update, sort=True)
 
-    df_update.dropna(inplace=True, how='all')
-    df_update.index = df_update.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
-    df_update = df_update.sort_index()
-    df_update.index.name = 'Timestamp'
+def get_regulating_prices(start_time, end_time, regions = [], currency = 'EUR', cache_dir = None):
 
-    # Slice for periods and regions
-    indx = (df_update.index >= t1) & (df_update.index <= t2)
+    return get_data('regulating-prices', start_time, end_time, regions, currency, cache_dir)
 
-    if len(regions) == 0:
-        df = df_update.loc[indx]
-    else:
-        df = df_update.loc[indx,regions]
-    
-    return df
 
 
+def get_regulating_volumes(start_time, end_time, regions = [], cache_dir = None):
 
-def get_elspot_volumes(start_time, end_time, regions = []):
+    return get_data('regulating-volumes', start_time, end_time, regions, None, cache_dir)
 
-    
-    data_url = 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/elspot-volumes_%s_hourly.xls'
+
+
+def get_data(dataset, start_time, end_time, regions = [], currency = None, cache_dir = None, max_workers = MAX_WORKERS):
+
+    ## Example
+    # from nordpool import get_data
+    #
+    # dataset = 'elspot-prices'/'elspot-volumes'/'regulating-prices'/'regulating-volumes'
+    # df = get_data('regulating-prices', '2020-10-01 00:00', '2020-12-15 23:00', regions = ['SE1'], currency = 'EUR')
+
+    # Shared engine of the four loaders, currency is only used for the price datasets
+    # The yearly files are downloaded concurrently with max_workers threads
+
+    if dataset.endswith('volumes'):
+        currency = None
+
+    t1, t2, years = _period(start_time, end_time)
+
+    df_years = _read_years([(dataset, year, currency) for year in years], cache_dir, max_workers)
+
+    return _assemble(dataset, df_years, t1, t2, regions)
+
+
+
+def get_datasets(start_time, end_time, datasets = ['elspot-prices', 'elspot-volumes', 'regulating-prices', 'regulating-volumes'], 
+                 regions = [], currency = 'EUR', cache_dir = None, max_workers = MAX_WORKERS):
+
+    ## Example
+    # from nordpool import get_datasets
+    #
+    # df = get_datasets('2015-01-01 00:00', '2021-12-31 22:00', regions = ['SE1'])
+    # df['elspot-prices']
+
+    # All years of all datasets are downloaded concurrently. The datasets are 
+    # joined on their UTC index with the dataset name as first column level,
+    # columns of single level datasets get an empty second level.
+
+    t1, t2, years = _period(start_time, end_time)
+
+    keys = [(dataset, year, None if dataset.endswith('volumes') else currency) for dataset in datasets for year in years]
+    df_years = _read_years(keys, cache_dir, max_workers)
+
+    dfs = []
+    for i, dataset in enumerate(datasets):
+        df = _assemble(dataset, df_years[i*len(years):(i+1)*len(years)], t1, t2, regions)
+        if df.columns.nlevels == 1:
+            df.columns = pd.MultiIndex.from_arrays([df.columns, [''] * len(df.columns)])
+        dfs.append(df)
+
+    df = pd.concat(dfs, axis=1, keys=datasets, sort=True)
+    df.index.name = 'Timestamp'
+
+    return df
+
+
+
+def _period(start_time, end_time):
 
     t1 = pd.to_datetime(start_time).tz_localize('UTC')
     t2 = pd.to_datetime(end_time).tz_localize('UTC') 
@@ -67,122 +130,143 @@ def get_elspot_volumes(start_time, end_time, regions = []):
 
     years = np.arange(t1_year, t2_year+1)
 
-    urls = [data_url % (year) for year in years]
+    return t1, t2, years
+
+
+
+def _read_years(keys, cache_dir, max_workers):
+
+    # _read_year() for every (dataset, year, currency) key, in the order of the keys
+
+    if max_workers <= 1 or len(keys) <= 1:
+        return [_read_year(dataset, year, currency, cache_dir) for dataset, year, currency in keys]
 
-    # Download data
-    df_update = []
-    for url in urls:
-        df_update_yr = pd.read_html(url, skiprows=2, header=0, index_col=[0, 1], decimal=',', thousands=' ')[0]
-        time_vector = pd.to_datetime(df_update_yr.reset_index().apply(lambda r: '%s %s:00' % (r[0], r[1][:2]), axis=1), format="%d-%m-%Y %H:%M")
-        df_update_yr.set_index(time_vector, inplace=True)
-        df_update.append(df_update_yr)
-    df_update = pd.concat(df_update, sort=True)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        futures = [executor.submit(_read_year, dataset, year, currency, cache_dir) for dataset, year, currency in keys]
+        return [f.result() for f in futures]
 
-    df_update.dropna(inplace=True, how='all')
-    df_update.index = df_update.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
-    df_update = df_update.sort_index()
-    df_update.index.name = 'Timestamp'
 
+
+def _assemble(dataset, df_years, t1, t2, regions):
+
+    # Each year is sliced for the period before concatenation
+    df = pd.concat([_slice_period(df_yr, t1, t2) for df_yr in df_years], sort=True)
+    df.index.name = 'Timestamp'
+
+    if dataset == 'elspot-volumes':
+        df.columns = _volume_columns(list(df))
+
+    # Slice for regions
+    if len(regions) > 0:
+        df = df.loc[:, regions]
     
+    return df
+
+
+
+def _slice_period(df, t1, t2):
+
+    # Rows t1 <= index <= t2 of a sorted index without a boolean mask over the full year
+
+    i1 = df.index.searchsorted(t1, side='left')
+    i2 = df.index.searchsorted(t2, side='right')
+
+    return df.iloc[i1:i2]
+
+
+
+def _volume_columns(lst):
+
     # Set multilevel columns
-    lst = list(df_update)
     la = list(filter(lambda k: 'Turnover' not in k, lst))
     lb = list(filter(lambda k: 'Turnover' in k, lst))
     
     cnames = [x.split() for x in la]
     cnames.append(lb)
     
-    df_update.columns = pd.MultiIndex.from_tuples(cnames)
+    return pd.MultiIndex.from_tuples(cnames)
 
-    # Slice for periods and regions
-    indx = (df_update.index >= t1) & (df_update.index <= t2)
 
-    if len(regions) == 0:
-        df = df_update.loc[indx]
-    else:
-        df = df_update.loc[indx,regions]
-    
-    return df
 
+def _parse_timestamps(index):
 
+    # Local (CET) time of the (date, hours) index of the market data files, e.g. ('24-10-2020', '02 - 03')
 
-def get_regulating_prices(start_time, end_time, regions = [], currency = 'EUR'):
+    dates = pd.to_datetime(index.get_level_values(0), format="%d-%m-%Y")
+    hours = pd.to_timedelta(index.get_level_values(1).str[:2].astype(int), unit='h')
 
-    
-    data_url = 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/regulating-prices_%s_hourly_%s.xls'
+    return dates + hours
 
-    t1 = pd.to_datetime(start_time).tz_localize('UTC')
-    t2 = pd.to_datetime(end_time).tz_localize('UTC') 
 
-    t1_year = t1.tz_convert('CET').year
-    t2_year = t2.tz_convert('CET').year
 
-    years = np.arange(t1_year, t2_year+1)
+def _download_year(dataset, year, currency=None):
 
-    urls = [data_url % (year, currency.lower()) for year in years]
+    if currency is None:
+        url = DATA_URLS[dataset] % year
+    else:
+        url = DATA_URLS[dataset] % (year, currency.lower())
 
-    # Download data
-    df_update = []
-    for url in urls:
-        df_update_yr = pd.read_html(url, skiprows=2, header=[0, 1], index_col=[0, 1], decimal=',', thousands=' ')[0]
-        time_vector = pd.to_datetime(df_update_yr.reset_index().apply(lambda r: '%s %s:00' % (r[0], r[1][:2]), axis=1), format="%d-%m-%Y %H:%M")
-        df_update_yr.set_index(time_vector, inplace=True)
-        df_update.append(df_update_yr)
-    df_update = pd.concat(df_update, sort=True)
+    df = pd.read_html(_fetch(url), skiprows=2, header=HEADER_ROWS[dataset], index_col=[0, 1], decimal=',', thousands=' ')[0]
 
-    df_update.dropna(inplace=True, how='all')
-    df_update.index = df_update.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
-    df_update = df_update.sort_index()
-    df_update.index.name = 'Timestamp'
+    return _parse_year(df)
 
-    # Slice for periods and regions
-    indx = (df_update.index >= t1) & (df_update.index <= t2)
 
-    if len(regions) == 0:
-        df = df_update.loc[indx]
-    else:
-        df = df_update.loc[indx,regions]
-    
-    return df
 
+def _fetch(url):
 
+    # File contents over the pooled session, local paths are passed to read_html as is
 
-def get_regulating_volumes(start_time, end_time, regions = []):
+    if not url.startswith(('http://', 'https://')):
+        return url
 
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, timeout=TIMEOUT)
+    r.raise_for_status()
 
-    data_url = 'https://www.nordpoolgroup.com/globalassets/marketdata-excel-files/regulating-volumes_%s_hourly.xls'
+    return io.StringIO(r.text)
 
-    t1 = pd.to_datetime(start_time).tz_localize('UTC')
-    t2 = pd.to_datetime(end_time).tz_localize('UTC') 
 
-    t1_year = t1.tz_convert('CET').year
-    t2_year = t2.tz_convert('CET').year
 
-    years = np.arange(t1_year, t2_year+1)
+def _parse_year(df):
 
-    urls = [data_url % (year) for year in years]
+    # Vectorized timestamps, the CET -> UTC conversion infers the 
+    # repeated October hour from the order of the rows
 
-    # Download data
-    df_update = []
-    for url in urls:
-        df_update_yr = pd.read_html(url, skiprows=2, header=[0, 1], index_col=[0, 1], decimal=',', thousands=' ')[0]
-        time_vector = pd.to_datetime(df_update_yr.reset_index().apply(lambda r: '%s %s:00' % (r[0], r[1][:2]), axis=1), format="%d-%m-%Y %H:%M")
-        df_update_yr.set_index(time_vector, inplace=True)
-        df_update.append(df_update_yr)
-    df_update = pd.concat(df_update, sort=True)
+    df.index = _parse_timestamps(df.index)
 
-    df_update.dropna(inplace=True, how='all')
-    df_update.index = df_update.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
-    df_update = df_update.sort_index()
-    df_update.index.name = 'Timestamp'
+    df = df.dropna(how='all')
+    df.index = df.index.tz_localize("CET", ambiguous='infer').tz_convert("UTC")
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
+    df.index.name = 'Timestamp'
 
-    # Slice for periods and regions
-    indx = (df_update.index >= t1) & (df_update.index <= t2)
+    return df
+
+
+
+def _read_year(dataset, year, currency=None, cache_dir=None):
+
+    # Parsed data of one year, from the Parquet cache in cache_dir when available
+    #
+    # A year is immutable once it was cached after the year ended (CET), 
+    # years cached while still open are downloaded again after CURRENT_YEAR_MAX_AGE
+
+    if cache_dir is None:
+        return _download_year(dataset, year, currency)
 
-    if len(regions) == 0:
-        df = df_update.loc[indx]
+    if currency is None:
+        path = os.path.join(cache_dir, '%s_%s.parquet' % (dataset, year))
     else:
-        df = df_update.loc[indx,regions]
-    
-    return df
+        path = os.path.join(cache_dir, '%s_%s_%s.parquet' % (dataset, year, currency.lower()))
+
+    if os.path.exists(path):
+        cached = pd.Timestamp(os.path.getmtime(path), unit='s', tz='UTC').tz_convert('CET')
+        if cached.year > year or time.time() - os.path.getmtime(path) < CURRENT_YEAR_MAX_AGE:
+            return pd.read_parquet(path)
+
+    df = _download_year(dataset, year, currency)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
 
+    return df
\ No newline at end of file
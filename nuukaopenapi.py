@@ -1,7 +1,28 @@
 # https://helsinki-openapi.nuuka.cloud/swagger/index.html
 
-import requests
+import os
+import json
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from httpsession import get_session
+
+
+API_URL = 'https://helsinki-openapi.nuuka.cloud/api/{}/{}'
+
+# Concurrent requests of the bulk calls, per request timeout (s) and retries of failed requests
+MAX_WORKERS = 8
+TIMEOUT = 60
+RETRIES = 3
+
+# Seconds the property list of PropertyCatalogue is reused
+CATALOGUE_TTL = 24*3600
+
+# Search records and the property list fields
+SEARCH_RECORDS = {'LocationName': 'locationName', 'PropertyCode': 'propertyCode', 'BuildingType': 'buildingType', 
+                  'PurposeOfUse': 'purposeOfUse', 'BuildingCode': 'buildingCode'}
     
 
 def get_property_list(api_version = 'v2.0'):
@@ -12,11 +33,11 @@ def get_property_list(api_version = 'v2.0'):
     # prop_list = get_property_list()   
         
 
-    url = 'https://helsinki-openapi.nuuka.cloud/api/{}/Property/List'.format(api_version)
+    url = API_URL.format(api_version, 'Property/List')
 
     
     print('Getting property list ...')        
-    r = requests.get(url)
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, timeout=TIMEOUT)
 
     # r.url
 
@@ -34,6 +55,107 @@ def get_property_list(api_version = 'v2.0'):
     
 
 
+class PropertyCatalogue:
+
+    ## Example
+    # from nuukaopenapi import PropertyCatalogue
+    #
+    # catalogue = PropertyCatalogue(cache_dir = 'nuuka_cache')
+    # prop_metadata = catalogue.search('1000 Hakaniemen kauppahalli')
+    # prop_metadata = catalogue.search('Hakaniemen', search_record = 'LocationName', match = 'substring')
+    #
+    # search_record = 'LocationName'/'PropertyCode'/'BuildingType'/'PurposeOfUse'/'BuildingCode'
+    # match = 'exact'/'prefix'/'substring'
+
+    # The property list is downloaded once per ttl (s), with cache_dir it is also kept on disk.
+    # Searches are answered from in-memory indexes of the search records with the rows of 
+    # searh_property_df(), every building of a property is indexed for BuildingCode.
+
+    def __init__(self, api_version = 'v2.0', cache_dir = None, ttl = CATALOGUE_TTL):
+
+        self.api_version = api_version
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.loaded = None
+
+
+    def refresh(self, force = False):
+
+        if not force and self.loaded is not None and time.time() - self.loaded < self.ttl:
+            return
+
+        d = None
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, 'property_list_%s.json' % self.api_version)
+            if not force and os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+                with open(path) as f:
+                    d = json.load(f)
+
+        if d is None:
+            print('Getting property list ...')        
+            r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(API_URL.format(self.api_version, 'Property/List'), timeout=TIMEOUT)
+            if r.status_code != 200:
+                print('API call issue')
+                print('Status code:',r.status_code)
+                if self.loaded is None:
+                    raise RuntimeError('Property list not available')
+                return
+            d = r.json()
+            if path is not None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(d, f)
+                os.replace(path + '.tmp', path)
+
+        self.df = _flatten_properties(d)
+
+        rows = np.arange(len(d))
+        self.indexes = {record: _search_index(self.df[field].astype(str).to_numpy(), rows) 
+                        for record, field in SEARCH_RECORDS.items() if record != 'BuildingCode'}
+
+        buildings = pd.Series([p['buildings'] for p in d]).explode().dropna()
+        self.indexes['BuildingCode'] = _search_index(buildings.str['buildingCode'].astype(str).to_numpy(), buildings.index.to_numpy())
+
+        self.loaded = time.time()
+
+
+    def search(self, search_string, search_record = 'LocationName', match = 'exact'):
+
+        self.refresh()
+
+        if search_record not in self.indexes:
+            raise ValueError('Unknown search record: %s' % search_record)
+        index = self.indexes[search_record]
+        search_string = str(search_string)
+
+        if match == 'exact':
+            rows = index['rows'].get(search_string, np.array([], dtype=int))
+        else:
+            if match == 'prefix':
+                keys = index['keys'][index['keys'].searchsorted(search_string, side='left'):index['keys'].searchsorted(search_string + '\U0010ffff', side='left')]
+            elif match == 'substring':
+                keys = index['keys'][np.char.find(index['keys'], search_string) >= 0]
+            else:
+                raise ValueError('Unknown match option: %s' % match)
+            rows = np.unique(np.concatenate([index['rows'][k] for k in keys])) if len(keys) > 0 else np.array([], dtype=int)
+
+        return self.df.iloc[rows]
+
+
+
+def _search_index(keys, rows):
+
+    # Rows of every key and the sorted keys for prefix and substring searches
+
+    codes, uniques = pd.factorize(keys)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+
+    return {'rows': dict(zip(uniques, np.split(rows[order], bounds))), 'keys': np.sort(np.asarray(uniques, dtype=str))}
+
+
+
 def searh_property(search_string, search_record = 'LocationName', api_version = 'v2.0'):
     
 
@@ -46,14 +168,14 @@ def searh_property(search_string, search_record = 'LocationName', api_version =
 
 
 
-    url = 'https://helsinki-openapi.nuuka.cloud/api/{}/Property/Search'.format(api_version)
+    url = API_URL.format(api_version, 'Property/Search')
 
 
     parameters = {'SearchString': search_string, \
                   'SearchFromRecord': search_record} 
     
     print('Generating API token ...')        
-    r = requests.get(url, params=parameters)
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, params=parameters, timeout=TIMEOUT)
 
     if r.status_code == 200:
         d = r.json()
@@ -82,27 +204,29 @@ def searh_property_df(search_string, search_record = 'LocationName', api_version
 
 
 
-    df = []
-    for i in range(0,len(d)):
+    if d is None:
+        return
 
-        d[i]['buildings'] = d[i]['buildings'][0]['buildingCode']
-        d[i]['buildingCode'] = d[i].pop('buildings')
+    df = _flatten_properties(d)
     
-        reportinggroup = []
-        for j in range(0,len(d[i]['reportingGroups'])):
-        
-            rg = d[i]['reportingGroups'][j]['name']
-        
-            reportinggroup.append(rg)
+    return df
 
-        d[i]['reportingGroups'] = [', '.join(reportinggroup)] 
-    
 
-        dfi = pd.DataFrame(d[i])
-        df.append(dfi)
 
-    df = pd.concat(df, axis=0)
-    
+def _flatten_properties(d):
+
+    # Property records as rows, the code of the first building as buildingCode and 
+    # the names of the reporting groups as one string
+
+    df = pd.DataFrame(d)
+    if len(df) == 0:
+        return df
+
+    df['buildingCode'] = df.pop('buildings').str[0].str['buildingCode']
+
+    names = df['reportingGroups'].explode().str['name'].dropna()
+    df['reportingGroups'] = names.groupby(level=0).agg(', '.join).reindex(df.index, fill_value='')
+
     return df
 
 
@@ -121,34 +245,106 @@ def get_property_data(search_string, reporting_group, start_time, end_time, time
     # data = get_property_data(search_string, reporting_group, start_time, end_time, time_group = time_group, search_record = search_record)     
 
 
-   
-    url = 'https://helsinki-openapi.nuuka.cloud/api/{}/EnergyData/{}/ListByProperty'.format(api_version, time_group)
 
-
-    parameters = {'SearchString': search_string, \
-                  'Record': search_record, \
-                  'ReportingGroup': reporting_group, \
-                  'StartTime': start_time, \
-                  'EndTime': end_time} 
-    
     print('Generating property data ...')        
-    r = requests.get(url, params=parameters)
+    status_code, df = _get_property_frame(search_string, reporting_group, start_time, end_time, time_group, search_record, api_version)
 
-    if r.status_code == 200:
-        d = r.json()
-        df = pd.DataFrame(d).set_index('timestamp')
-        df.index = pd.to_datetime(df.index)
+    if status_code == 200:
+        if df is None:
+            print('No data for this period')
+            return
         df = get_local_timeindex(df)
     
     else:
         print('API call issue')
-        print('Status code:',r.status_code)
+        print('Status code:',status_code)
         return
                     
     return df
 
 
 
+def get_property_data_bulk(pairs, start_time, end_time, time_group = 'hourly', search_record = 'LocationName', api_version = 'v2.0', 
+                           max_workers = MAX_WORKERS, panel = False):
+
+    ## Example
+    # from nuukaopenapi import get_property_data_bulk
+    # 
+    # search_strings = ['1000 Hakaniemen kauppahalli', ...]
+    # reporting_groups = ['Electricity', 'Heat']
+    # pairs = [(s, g) for s in search_strings for g in reporting_groups]
+    # data = get_property_data_bulk(pairs, start_time, end_time, max_workers = 8)
+
+    # The (search_string, reporting_group) pairs are fetched with max_workers concurrent 
+    # requests over one pooled session. data is indexed by (search_string, reporting_group, timestamp),
+    # with panel = True the values are returned with one (search_string, reporting_group) column per pair.
+    # Pairs that fail are reported and skipped.
+
+
+    print('Generating property data ...')        
+    args = [(ss, rg, start_time, end_time, time_group, search_record, api_version) for ss, rg in pairs]
+
+    if max_workers <= 1 or len(args) <= 1:
+        results = [_get_property_frame(*a) for a in args]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(args))) as executor:
+            futures = [executor.submit(_get_property_frame, *a) for a in args]
+            results = [f.result() for f in futures]
+
+    dfs = []
+    keys = []
+    for (ss, rg), (status_code, df) in zip(pairs, results):
+        if status_code != 200:
+            print('API call issue')
+            print('Property:', ss, rg)
+            print('Status code:',status_code)
+        elif df is not None:
+            dfs.append(df)
+            keys.append((ss, rg))
+
+    if len(dfs) == 0:
+        print('No data for this period')
+        return
+
+    df = get_local_timeindex(pd.concat(dfs, keys=keys, names=['search_string', 'reporting_group']))
+
+    if panel:
+        df = df['value'].unstack(['search_string', 'reporting_group'])
+                    
+    return df
+
+
+
+def _get_property_frame(search_string, reporting_group, start_time, end_time, time_group, search_record, api_version):
+
+    # (status code, DataFrame) of one property and reporting group in local time without time zone
+    # The DataFrame is None when there is no data
+
+    url = API_URL.format(api_version, 'EnergyData/{}/ListByProperty'.format(time_group))
+
+
+    parameters = {'SearchString': search_string, \
+                  'Record': search_record, \
+                  'ReportingGroup': reporting_group, \
+                  'StartTime': start_time, \
+                  'EndTime': end_time} 
+    
+    r = get_session(pool_size=MAX_WORKERS, retries=RETRIES).get(url, params=parameters, timeout=TIMEOUT)
+
+    if r.status_code != 200:
+        return r.status_code, None
+
+    d = r.json()
+    if len(d) == 0:
+        return 200, None
+
+    df = pd.DataFrame(d).set_index('timestamp')
+    df.index = pd.to_datetime(df.index)
+
+    return 200, df
+
+
+
 def get_local_timeindex(df):
     
     # Nuuka data time is local time in Helsinki
@@ -157,23 +353,47 @@ def get_local_timeindex(df):
     # Instead there is only one timestamp that contains the aggregated quantity of the dublicate hours
     # This stript infers the local time fixing the issue above 
     
-    # Get local time index which has 'NaT' in the ambiguous rows
-    indx = df.index.tz_localize(tz='Europe/Helsinki', ambiguous='NaT', nonexistent='raise')
+    # Every row of the aggregated hour is split into two rows with half the value in one pass,
+    # df can hold several properties with timestamp as the last index level (get_property_data_bulk)
 
+    tz = 'Europe/Helsinki'
 
-    # Devide ambiguous rows by two to get the single hour quantity
-    df.loc[indx.isnull(),'value'] = df.loc[indx.isnull(),'value']/2
-    
-    # Dublicate ambiguous rows
-    df = df.reset_index()
-    dslice = df.iloc[indx.isnull(),:]
-    dslice.index = dslice.index+0.5
-    df = df.append(dslice, ignore_index=False)
-    df = df.sort_index().reset_index(drop=True)
-    df = df.set_index('timestamp')
-    
-    # Change dataframe index to local time and infer ambiguous rows
-    df.index = df.index.tz_localize(tz='Europe/Helsinki', ambiguous='infer', nonexistent='raise')
+    # Both UTC offsets of the distinct timestamps, they only differ in the ambiguous hour
+    if df.index.nlevels > 1:
+        codes, uniques = np.asarray(df.index.codes[-1]), df.index.levels[-1]
+    else:
+        codes, uniques = pd.factorize(df.index)
+    uniques = pd.DatetimeIndex(uniques)
+    dst = uniques.tz_localize(tz, ambiguous=np.ones(len(uniques), dtype=bool), nonexistent='raise')
+    std = uniques.tz_localize(tz, ambiguous=np.zeros(len(uniques), dtype=bool), nonexistent='raise')
+    ambiguous_times = np.asarray(dst != std)
+    ambiguous = ambiguous_times[codes]
+
+    # Ambiguous rows are repeated in place, the first one is the daylight saving hour
+    reps = np.where(ambiguous, 2, 1)
+    positions = np.repeat(np.arange(len(df)), reps)
+    second = np.zeros(len(positions), dtype=bool)
+    second[(np.cumsum(reps) - 1)[ambiguous]] = True
+
+    df = df.take(positions)
+    df['value'] = np.where(ambiguous[positions], df['value']/2, df['value'])
+
+    # Local times of the rows as codes into the daylight saving and the standard times of the ambiguous hour
+    local = dst.append(std[ambiguous_times])
+    local_codes = codes[positions]
+    local_codes[second] = len(uniques) + (np.cumsum(ambiguous_times) - 1)[local_codes[second]]
+
+    # Sorted level
+    order = local.argsort()
+    rank = np.empty(len(order), dtype=local_codes.dtype)
+    rank[order] = np.arange(len(order))
+    local = local[order]
+    local_codes = rank[local_codes]
+
+    if df.index.nlevels > 1:
+        df.index = pd.MultiIndex(levels=list(df.index.levels[:-1]) + [local], codes=list(df.index.codes[:-1]) + [local_codes], 
+                                 names=df.index.names, verify_integrity=False)
+    else:
+        df.index = local.take(local_codes).rename(df.index.name)
 
     return df
-
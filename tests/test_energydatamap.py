@@ -0,0 +1,88 @@
+import os
+import json
+
+import pytest
+import pandas as pd
+
+import energydatamap
+
+
+# API response of the solar endpoint for energydatamap.REFERENCE_CAPACITY kW
+PAYLOAD = os.path.join(os.path.dirname(__file__), 'data', 'energydatamap_solar.json')
+
+PARAMETERS = {'longitude': 7, 'latitude': 51, 'capacity_kw': 1200, 'azimuth': 170, 'tilt': 10,
+              'start_date': '2020-01-01', 'end_date': '2020-01-01', 'frequency': '60min'}
+
+
+
+class _Response:
+
+    def __init__(self, payload):
+        self.status_code = 200
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+
+class _Session:
+
+    # Payload with the generation of params['capacity_kw']
+
+    def __init__(self):
+        with open(PAYLOAD) as f:
+            self.payload = json.load(f)
+        self.calls = 0
+
+    def get(self, url, params=None, timeout=None):
+        self.calls += 1
+        factor = params['capacity_kw']/energydatamap.REFERENCE_CAPACITY
+        return _Response([dict(r, pv_generation=r['pv_generation']*factor) for r in self.payload])
+
+
+
+@pytest.fixture
+def session(monkeypatch):
+    s = _Session()
+    monkeypatch.setattr(energydatamap, 'get_session', lambda **kwargs: s)
+    return s
+
+
+
+def test_response_frame(session):
+
+    df = energydatamap.get_pv_generation_data(dict(PARAMETERS, capacity_kw=energydatamap.REFERENCE_CAPACITY))
+
+    assert list(df.columns) == ['pv_generation', 'temperature']
+    assert df.index[0] == pd.Timestamp('2020-01-01 06:00', tz='UTC')
+    assert df['pv_generation'].tolist() == [r['pv_generation'] for r in session.payload]
+
+
+
+def test_cache_scales_generation(session, tmp_path):
+
+    capacities = [10, 250, 1200]
+    dfs = energydatamap.get_pv_generation_batch([dict(PARAMETERS, capacity_kw=c) for c in capacities], cache_dir=str(tmp_path),
+                                                columns=['pv_generation'])
+    assert session.calls == 1
+
+    df = energydatamap.get_pv_generation_data(PARAMETERS, cache_dir=str(tmp_path), columns=['pv_generation'])
+    assert session.calls == 1
+
+    expected = energydatamap.get_pv_generation_data(PARAMETERS)
+    pd.testing.assert_frame_equal(df, expected)
+
+    for c, d in zip(capacities, dfs):
+        assert d['pv_generation'].to_numpy() == pytest.approx(expected['pv_generation'].to_numpy()*c/PARAMETERS['capacity_kw'])
+        assert d['temperature'].tolist() == expected['temperature'].tolist()
+
+
+
+def test_cache_columns(session, tmp_path):
+
+    df = energydatamap.get_pv_generation_data(PARAMETERS, cache_dir=str(tmp_path))
+    assert df['temperature'].iloc[0] == pytest.approx(-1.2*1.2)
+
+    with pytest.raises(KeyError):
+        energydatamap.get_pv_generation_data(PARAMETERS, cache_dir=str(tmp_path), columns=['generation'])